@@ -0,0 +1,146 @@
+"""
+asyncio facade over a load_db database, queries run on a bounded thread pool.
+Best used with load_db(..., read_only=True), every query checks out its own pooled read connection.
+Usage:
+    adb = AsyncBooruDB(load_db("gelbooru2024-02.db", read_only=True))
+    post = await adb.get_post(1)
+    post_ids = await adb.search_tags(include=["1girl", "solo"], exclude=["monochrome"], ratings=["general"], limit=100)
+    posts = await adb.get_posts_with_tags(post_ids) # post.tag_list_general etc. do not query again
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from peewee import fn
+from post_sampler import PostSampler
+
+class QueryCancelled(Exception):
+    """
+    Raised in the worker thread when the awaiting task was cancelled
+    """
+
+class AsyncBooruDB:
+    """
+    Runs the queries of a db_dict on at most max_workers threads (default: the read pool size).
+    Cancelling an awaiting task interrupts its SQLite query through a progress handler.
+    Concurrent get_post calls for the same id share one query.
+    tag_index (a tag_index.TagIndex) is used for search_tags when given, otherwise PostTagRelation is queried.
+    """
+    def __init__(self, db_dict: dict, max_workers=None, tag_index=None):
+        self.db_dict = db_dict
+        self.db = db_dict["db"]
+        self.tag_index = tag_index
+        max_workers = max_workers or getattr(self.db, "_max_connections", None) or 8
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="booru-db")
+        self._inflight = {} # key -> [task, number of waiters]
+        self.sampler = PostSampler(db_dict, tag_index=tag_index)
+
+    def _call(self, cancel_event, func, args):
+        """
+        Runs func(*args) in a worker thread on a checked out connection
+        """
+        if cancel_event.is_set():
+            raise QueryCancelled()
+        with self.db.connection_context():
+            conn = self.db.connection()
+            # a non-zero return aborts the running statement
+            conn.set_progress_handler(lambda: 1 if cancel_event.is_set() else 0, 1000)
+            try:
+                return func(*args)
+            finally:
+                conn.set_progress_handler(None, 0)
+
+    async def run(self, func, *args):
+        """
+        Runs a blocking function of the models on the executor, cancelling the task interrupts the query
+        """
+        cancel_event = threading.Event()
+        future = asyncio.get_running_loop().run_in_executor(self.executor, self._call, cancel_event, func, args)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            cancel_event.set()
+            raise
+
+    async def _coalesced(self, key, func, *args):
+        """
+        Awaits the in-flight query of key, or starts it. The query is cancelled once all of its waiters are.
+        """
+        entry = self._inflight.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(self.run(func, *args))
+            entry = self._inflight[key] = [task, 0]
+            task.add_done_callback(lambda _: self._inflight.pop(key, None) if self._inflight.get(key) is entry else None)
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        except asyncio.CancelledError:
+            if entry[1] == 1 and not entry[0].done():
+                entry[0].cancel()
+            raise
+        finally:
+            entry[1] -= 1
+
+    def _get_post(self, post_id):
+        return self.db_dict["Post"].get_or_none(self.db_dict["Post"].id == post_id)
+
+    async def get_post(self, post_id: int):
+        """
+        Returns the post of post_id or None. Only its columns are loaded, use get_posts_with_tags for tags.
+        """
+        return await self._coalesced(("post", post_id), self._get_post, post_id)
+
+    def _get_posts_with_tags(self, post_ids):
+        Post = self.db_dict["Post"]
+        posts = self.db_dict["prefetch_tags"](Post.select().where(Post.id.in_(post_ids)))
+        by_id = {post.id: post for post in posts}
+        return [by_id[post_id] for post_id in post_ids if post_id in by_id]
+
+    async def get_posts_with_tags(self, post_ids):
+        """
+        Returns the existing posts of post_ids in the given order, with their tags prefetched
+        """
+        return await self.run(self._get_posts_with_tags, list(post_ids))
+
+    def _search_tags(self, include, exclude, ratings, limit, after_id):
+        if self.tag_index is not None:
+            post_ids = self.tag_index.query(include=include, exclude=exclude, ratings=ratings)
+            return post_ids[post_ids > after_id][:limit].tolist()
+        Post, Tag, PostTagRelation = self.db_dict["Post"], self.db_dict["Tag"], self.db_dict["PostTagRelation"]
+        include_ids = [tag_id for tag_id, in Tag.select(Tag.id).where(Tag.name.in_(include)).tuples()] if include else []
+        if len(include_ids) != len(set(include)):
+            return [] # an include tag does not exist
+        query = Post.select(Post.id).where(Post.id > after_id)
+        if include_ids:
+            matching = (PostTagRelation.select(PostTagRelation.post).where(PostTagRelation.tag.in_(include_ids))
+                        .group_by(PostTagRelation.post).having(fn.COUNT(PostTagRelation.tag) == len(include_ids)))
+            query = query.where(Post.id.in_(matching))
+        if exclude:
+            excluded = PostTagRelation.select(PostTagRelation.post).join(Tag).where(Tag.name.in_(exclude))
+            query = query.where(Post.id.not_in(excluded))
+        if ratings is not None:
+            query = query.where(Post.rating.in_([Post.rating.enum_map[rating] if isinstance(rating, str) else rating for rating in ratings]))
+        return [post_id for post_id, in query.order_by(Post.id).limit(limit).tuples()]
+
+    async def search_tags(self, include=(), exclude=(), ratings=None, limit=100, after_id=-1):
+        """
+        Returns up to limit ids (ascending, greater than after_id) of posts having all include tags,
+        none of the exclude tags and one of the ratings. Page with after_id=last returned id.
+        """
+        return await self.run(self._search_tags, list(include), list(exclude), ratings, limit, after_id)
+
+    async def sample(self, k=1, with_tags=False, sampler:PostSampler=None):
+        """
+        Returns k random posts (fewer if there are fewer candidates), with their tags prefetched if with_tags.
+        sampler draws filtered or weighted samples, the default one is uniform over every post.
+        """
+        post_ids = await self.run((sampler or self.sampler).sample_ids, k)
+        if with_tags:
+            return await self.get_posts_with_tags(post_ids)
+        Post = self.db_dict["Post"]
+        return await self.run(lambda: list(Post.select().where(Post.id.in_(post_ids))))
+
+    def close(self):
+        """
+        Waits for the running queries and stops the executor
+        """
+        self.executor.shutdown(wait=True)
@@ -1,14 +1,25 @@
 from db import *
 import json
 import os
+import time
+import queue
+import multiprocessing
+import numpy as np
 from tqdm import tqdm
 from functools import cache
+from post_sampler import PostSampler
 import tarfile
+import io
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 Tag = None
 Post = None
 PostTagRelation = None
 LocalPost = None
+IngestProgress = None
 tags = None
 get_tag_by_id = None
 db = None
@@ -38,19 +49,78 @@ def create_tag_or_use(tag_name: str, tag_type: str, optional_tag_id: int = None)
     tag.popularity = 1
     return tag
 
-def iterate_jsonl(file_path: str):
+# name -> (loads, accepts memoryview). loads must raise ValueError on invalid input.
+JSON_BACKENDS = {
+    "json": (json.loads, False),
+}
+if orjson is not None:
+    JSON_BACKENDS["orjson"] = (orjson.loads, True)
+json_backend = "orjson" if orjson is not None else "json"
+JSONL_CHUNK_SIZE = 1 << 22 # 4MiB reads
+
+def set_json_backend(name: str):
+    """
+    Set the default json parser used by iterate_jsonl.
+    """
+    global json_backend
+    if name not in JSON_BACKENDS:
+        raise ValueError(f"Unknown json backend {name}, available: {list(JSON_BACKENDS)}")
+    json_backend = name
+
+def iterate_lines(f, chunk_size=JSONL_CHUNK_SIZE, start_offset=0):
+    """
+    Yield (line, end offset) for each non-empty line of a binary file object.
+    The line is a memoryview without the newline, the end offset is the byte offset just after it (counted from start_offset).
+    The file is read in large chunks and the lines are not copied, so each view is only valid until the next one is requested.
+    """
+    tail = b""
+    position = start_offset # offset of chunk[0]
+    while chunk := f.read(chunk_size):
+        if tail:
+            chunk = tail + chunk
+        view = memoryview(chunk)
+        start = 0
+        while (end := chunk.find(b"\n", start)) != -1:
+            if end > start:
+                yield view[start:end], position + end + 1
+            start = end + 1
+        tail = chunk[start:]
+        position += start
+    if tail:
+        yield memoryview(tail), position + len(tail)
+
+def iterate_jsonl(file_path: str, backend: str = None, chunk_size=JSONL_CHUNK_SIZE, with_offsets=False, start_offset=0):
     """
     Iterate through a jsonl file and yield each line as a dictionary.
+    file_path can be a path or a binary file-like object (e.g. tar.extractfile), lines that fail to parse are skipped.
+    backend defaults to orjson if installed, otherwise json (see set_json_backend).
+    with_offsets=True yields (dictionary, end offset of the line) instead, starting at start_offset (binary input only).
     """
+    loads, accepts_view = JSON_BACKENDS[backend or json_backend]
     if isinstance(file_path, str) and os.path.exists(file_path):
-        with open(file_path, "r") as f:
-            for line in f:
-                yield json.loads(line)
+        with open(file_path, "rb") as f:
+            if start_offset:
+                f.seek(start_offset)
+            yield from iterate_jsonl(f, backend, chunk_size, with_offsets, start_offset)
+        return
+    if isinstance(file_path, io.TextIOBase):
+        if with_offsets:
+            raise ValueError("with_offsets requires a binary file")
+        lines = ((line, None) for line in file_path if line.strip())
     elif hasattr(file_path, "read"):
-        for line in file_path:
-            yield json.loads(line)
+        lines = iterate_lines(file_path, chunk_size, start_offset)
     else:
         raise ValueError("file_path must be a string or a file-like object")
+    skipped = 0
+    for line, offset in lines:
+        try:
+            data = loads(line if accepts_view or isinstance(line, str) else bytes(line))
+        except ValueError:
+            skipped += 1
+            continue
+        yield (data, offset) if with_offsets else data
+    if skipped:
+        print(f"Skipped {skipped} lines that failed to parse in {getattr(file_path, 'name', file_path)}")
 JSONL_RATING_CONVERSION = {
     "q": "questionable",
     "s": "sensitive",
@@ -59,13 +129,46 @@ JSONL_RATING_CONVERSION = {
     "safe" : "general",
 }
 
+# json key of the tag string -> tag type
+TAG_STRING_KEYS = [
+    ("tag_string_general", "general"),
+    ("tag_string_artist", "artist"),
+    ("tag_string_character", "character"),
+    ("tag_string_copyright", "copyright"),
+    ("tag_string_meta", "meta"),
+    ("tags", "unknown"), # tags -> unknown
+]
+
+POST_KEYS = [
+    "id", "created_at", "uploader_id", "source", "md5", "parent_id", "has_children", "is_deleted", "is_banned", "pixiv_id", "has_active_children", "bit_flags", "has_large", "has_visible_children", "image_width", "image_height", "file_size", "file_ext", "rating", "score", "up_score", "down_score", "fav_count", "file_url", "large_file_url", "preview_file_url"
+]
+
+SQLITE_MAX_VARIABLES = 32766 # default for sqlite >= 3.32, use 999 for older builds
+
+def insert_rows(model, fields, rows, convert=True):
+    """
+    Insert rows (tuples ordered as fields) with one executemany.
+    Values are converted through the fields like peewee does, unless convert is False (rows already hold raw values).
+    """
+    columns = ", ".join(f'"{field.column_name}"' for field in fields)
+    placeholders = ", ".join("?" for _ in fields)
+    sql = f'INSERT INTO "{model._meta.table_name}" ({columns}) VALUES ({placeholders})'
+    if convert:
+        converters = [field.db_value for field in fields]
+        rows = (tuple(converter(value) for converter, value in zip(converters, row)) for row in rows)
+    model._meta.database.cursor().executemany(sql, rows)
+
+def split_tags(tag_string:str):
+    """
+    Split a tag string into tag names, skipping empty tokens.
+    """
+    return [tag for tag in tag_string.split(" ") if tag and not tag.isspace()]
+
 def create_tags(tag_string:str, tag_type:str):
     """
     Create tags from a tag string.
     """
-    for tag in tag_string.split(" "):
-        if not tag or tag.isspace():
-            continue
+    for tag in split_tags(tag_string):
         tag = create_tag_or_use(tag, tag_type)
         yield tag
 # 'id', 'created_at', 'score', 'width', 'height', 'md5', 'directory', 'image', 'rating', 'source', 'change', 'owner', 'creator_id', 'parent_id', 'sample', 'preview_height', 'preview_width', 'tags', 'title', 'has_notes', 'has_comments', 'file_url', 'preview_url', 'sample_url', 'sample_height', 'sample_width', 'status', 'post_locked', 'has_children'
@@ -79,6 +182,16 @@ def get_conversion_key(data, key: str):
         return JSONL_RATING_CONVERSION.get(data.get(access_key, None), data.get(access_key, None))
     return data.get(access_key, None)
 
+def parse_post(json_data):
+    """
+    Parse a json dictionary into a compact (post row, tags) tuple.
+    The post row is ordered as POST_KEYS, tags is a list of (tag name, tag type).
+    """
+    assert "id" in json_data, "id is not in json_data"
+    row = tuple(get_conversion_key(json_data, key) for key in POST_KEYS)
+    tags = [(tag, tag_type) for key, tag_type in TAG_STRING_KEYS for tag in split_tags(json_data.get(key, ""))]
+    return row, tags
+
 def create_post(json_data, policy="ignore"):
     """
     Create a post from a json dictionary.
@@ -87,33 +200,210 @@ def create_post(json_data, policy="ignore"):
     """
     assert "id" in json_data, "id is not in json_data"
     post_id = json_data["id"]
-    all_tags = []
-    all_tags += [create_tags(json_data.get("tag_string_general", ""), "general")]
-    all_tags += [create_tags(json_data.get("tag_string_artist", ""), "artist")]
-    all_tags += [create_tags(json_data.get("tag_string_character", ""), "character")]
-    all_tags += [create_tags(json_data.get("tag_string_copyright", ""), "copyright")]
-    all_tags += [create_tags(json_data.get("tag_string_meta", ""), "meta")]
-    # tags -> unknown
-    all_tags += [create_tags(json_data.get("tags", ""), "unknown")]
+    all_tags = [create_tags(json_data.get(key, ""), tag_type) for key, tag_type in TAG_STRING_KEYS]
     if Post.get_or_none(Post.id == post_id) is not None:
         if policy == "ignore":
             print(f"Post {post_id} already exists")
             return
         elif policy == "replace":
             Post.delete_by_id(post_id)
+            PostTagRelation.delete().where(PostTagRelation.post == post_id).execute()
+            if Post._tag_blob_ready:
+                # the relations are recreated below, the blob would keep the old tags
+                PostTagBlob = Post.tag_blob.rel_model
+                PostTagBlob.delete().where(PostTagBlob.post == post_id).execute()
         else:
             raise ValueError(f"Unknown policy {policy}, must be 'ignore' or 'replace'")
-    post = Post.create(
-        **{key: get_conversion_key(json_data, key) for key in[
-            "id", "created_at", "uploader_id", "source", "md5", "parent_id", "has_children", "is_deleted", "is_banned", "pixiv_id", "has_active_children", "bit_flags", "has_large", "has_visible_children", "image_width", "image_height", "file_size", "file_ext", "rating", "score", "up_score", "down_score", "fav_count", "file_url", "large_file_url", "preview_file_url"
-        ]
-        }
-    )
+    post_data = {key: get_conversion_key(json_data, key) for key in POST_KEYS}
+    if "created_at_epoch" in Post._meta.fields:
+        post_data["created_at_epoch"] = parse_created_at(post_data["created_at"])
+    post = Post.create(**post_data)
     for tags in all_tags:
         for tag in tags:
             PostTagRelation.create(post=post, tag=tag)
     return post
 
+class TagTable:
+    """
+    In-memory tag name -> tag id table for bulk ingestion.
+    The tag table is loaded once, new tags get their ids assigned in memory and are written out in bulk by flush().
+    Like get_or_create_tag, the first type seen for a name wins.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.pending = [] # (id, name, type, popularity) rows not yet written
+        self.next_id = 1
+        self.load()
+
+    def load(self):
+        """
+        (Re)load the name -> id table from the database, dropping unwritten tags.
+        """
+        self.ids = dict(Tag.select(Tag.name, Tag.id).tuples())
+        self.next_id = (Tag.select(fn.MAX(Tag.id)).scalar() or 0) + 1
+        self.pending = []
+
+    def get_id(self, tag_name: str, tag_type: str):
+        """
+        Return the id of the tag, assigning a new one if the name is unknown.
+        """
+        tag_id = self.ids.get(tag_name)
+        if tag_id is None:
+            tag_id = self.next_id
+            self.next_id += 1
+            self.ids[tag_name] = tag_id
+            self.pending.append((tag_id, tag_name, tag_type, 0))
+        return tag_id
+
+    def flush(self):
+        """
+        Insert the new tags into the database.
+        """
+        insert_rows(Tag, [Tag.id, Tag.name, Tag.type, Tag.popularity], self.pending)
+        self.pending = []
+
+    def __len__(self):
+        return len(self.ids)
+
+class PostBatchWriter:
+    """
+    Buffers parsed posts and writes them with multi-row INSERTs.
+    Posts are flushed every batch_size posts, and the transaction is committed every commit_every posts.
+    Tags are resolved through a TagTable, so no per-tag queries are made.
+    If the PostTagBlob table exists, the blobs of the written posts are rewritten with the relations.
+    before_commit, if set, is called inside the transaction right before each commit (e.g. to store progress).
+        Policy can be 'ignore' or 'replace'
+    Usage:
+        with PostBatchWriter(policy) as writer:
+            for json_data in iterate_jsonl(file_path):
+                writer.add(json_data)
+    """
+    def __init__(self, policy="ignore", batch_size=1000, commit_every=100000, tag_table: TagTable = None):
+        if policy not in ("ignore", "replace"):
+            raise ValueError(f"Unknown policy {policy}, must be 'ignore' or 'replace'")
+        self.policy = policy
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.tag_table = tag_table
+        self.before_commit = None
+        self.pending = {} # post id -> (post row, [(tag name, tag type), ...])
+        self.uncommitted = 0
+        self.posts_written = 0
+        self.posts_skipped = 0
+        self.relations_written = 0
+        self.start_time = None
+        self._atomic = None
+        self._transaction = None
+
+    def __enter__(self):
+        assert db is not None, "Database is not loaded"
+        self.start_time = time.time()
+        if self.tag_table is None:
+            self.tag_table = TagTable()
+        self._atomic = db.atomic()
+        self._transaction = self._atomic.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+            if self.before_commit is not None:
+                self.before_commit()
+        result = self._atomic.__exit__(exc_type, exc_value, traceback)
+        if exc_type is not None:
+            # the uncommitted tags were rolled back
+            self.tag_table.load()
+        return result
+
+    def add(self, json_data):
+        """
+        Parse a json dictionary and buffer it.
+        """
+        self.add_parsed(*parse_post(json_data))
+
+    def add_parsed(self, row, tags):
+        """
+        Buffer an already parsed post row (ordered as POST_KEYS) and its (tag name, tag type) pairs.
+        """
+        post_id = row[0]
+        if post_id in self.pending and self.policy == "ignore":
+            self.posts_skipped += 1
+            return
+        self.pending[post_id] = (row, tags)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered posts and their tag relations, then commit if the commit window is full.
+        """
+        if not self.pending:
+            return
+        existing = set()
+        for post_ids in chunked(list(self.pending), SQLITE_MAX_VARIABLES):
+            existing.update(post_id for post_id, in Post.select(Post.id).where(Post.id.in_(post_ids)).tuples())
+        if existing:
+            if self.policy == "ignore":
+                for post_id in existing:
+                    del self.pending[post_id]
+                self.posts_skipped += len(existing)
+            else:
+                for post_ids in chunked(list(existing), SQLITE_MAX_VARIABLES):
+                    PostTagRelation.delete().where(PostTagRelation.post.in_(post_ids)).execute()
+                    Post.delete().where(Post.id.in_(post_ids)).execute()
+        post_rows = []
+        relation_rows = []
+        blob_rows = []
+        for post_id, (row, tags) in self.pending.items():
+            post_rows.append(row)
+            tag_ids = {self.tag_table.get_id(tag_name, tag_type): None for tag_name, tag_type in tags}
+            relation_rows.extend((post_id, tag_id) for tag_id in tag_ids)
+            if Post._tag_blob_ready:
+                blob_rows.append((post_id, np.array(list(tag_ids), dtype=TAG_BLOB_DTYPE).tobytes()))
+        self.tag_table.flush()
+        if Post._tag_blob_ready:
+            PostTagBlob = Post.tag_blob.rel_model
+            for post_ids in chunked(list(self.pending), SQLITE_MAX_VARIABLES):
+                PostTagBlob.delete().where(PostTagBlob.post.in_(post_ids)).execute()
+            insert_rows(PostTagBlob, [PostTagBlob.post, PostTagBlob.tag_ids], blob_rows, convert=False)
+        post_fields = [getattr(Post, key) for key in POST_KEYS]
+        if "created_at_epoch" in Post._meta.fields:
+            post_fields.append(Post.created_at_epoch)
+            post_rows = [row + (parse_created_at(row[1]),) for row in post_rows]
+        insert_rows(Post, post_fields, post_rows)
+        insert_rows(PostTagRelation, [PostTagRelation.post, PostTagRelation.tag], relation_rows, convert=False)
+        self.posts_written += len(post_rows)
+        self.relations_written += len(relation_rows)
+        self.uncommitted += len(post_rows)
+        self.pending = {}
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        """
+        Commit the current window and begin a new one.
+        """
+        if self.before_commit is not None:
+            self.before_commit()
+        self._transaction.commit()
+        self.uncommitted = 0
+
+    def rate(self):
+        """
+        Returns written posts per second
+        """
+        if self.start_time is None:
+            return 0
+        return self.posts_written / max(time.time() - self.start_time, 1e-9)
+
+    def report(self):
+        """
+        Print out the ingestion statistics
+        """
+        elapsed = time.time() - self.start_time if self.start_time is not None else 0
+        print(f"Wrote {self.posts_written} posts and {self.relations_written} tag relations in {elapsed:.1f}s "
+              f"({self.rate():.0f} posts/s), skipped {self.posts_skipped} posts")
+
 def read_and_create_posts(file_path: str, policy="ignore"):
     """
     Read a jsonl file and create the posts in the database.
@@ -123,11 +413,12 @@ def read_and_create_posts(file_path: str, policy="ignore"):
         create_post(json_data, policy)
         #print(f"Created post {json_data['id']}")
 
-def create_db_from_folder(folder_path: str, policy="ignore"):
+def create_db_from_folder(folder_path: str, policy="ignore", bulk=True, batch_size=1000, commit_every=100000):
     """
     Create a database from a folder of jsonl files.
     This recursively searches the folder for jsonl files.
         Policy can be 'ignore' or 'replace'
+        bulk=False falls back to create_post per post.
     """
     global db
     assert db is not None, "Database is not loaded"
@@ -136,14 +427,24 @@ def create_db_from_folder(folder_path: str, policy="ignore"):
         for file in files:
             if file.endswith(".jsonl"):
                 all_jsonl_files.append(os.path.join(root, file))
-    with db.atomic():
-        for file in tqdm(all_jsonl_files):
-            read_and_create_posts(file, policy)
+    if not bulk:
+        with db.atomic():
+            for file in tqdm(all_jsonl_files):
+                read_and_create_posts(file, policy)
+        return
+    with PostBatchWriter(policy, batch_size, commit_every) as writer:
+        pbar = tqdm(all_jsonl_files)
+        for file in pbar:
+            for json_data in iterate_jsonl(file):
+                writer.add(json_data)
+            pbar.set_postfix(posts=writer.posts_written, rate=f"{writer.rate():.0f}/s")
+    writer.report()
 
-def create_db_from_tarfile(tarfile_path: str, policy="ignore", read_method="r:gz"):
+def create_db_from_tarfile(tarfile_path: str, policy="ignore", read_method="r:gz", bulk=True, batch_size=1000, commit_every=100000):
     """
     Create a database from a tarfile of jsonl files.
         Policy can be 'ignore' or 'replace'
+        bulk=False falls back to create_post per post.
     """
     global db
     assert db is not None, "Database is not loaded"
@@ -152,19 +453,234 @@ def create_db_from_tarfile(tarfile_path: str, policy="ignore", read_method="r:gz
         for tarinfo in tar:
             if tarinfo.isfile() and tarinfo.name.endswith(".jsonl"):
                 all_jsonl_files.append(tarinfo)
-        with db.atomic():
-            for tarinfo in tqdm(all_jsonl_files):
+        if not bulk:
+            with db.atomic():
+                for tarinfo in tqdm(all_jsonl_files):
+                    with tar.extractfile(tarinfo) as f:
+                        for json_data in iterate_jsonl(f):
+                            create_post(json_data, policy)
+                            #print(f"Created post {json_data['id']}")
+            return
+        with PostBatchWriter(policy, batch_size, commit_every) as writer:
+            pbar = tqdm(all_jsonl_files)
+            for tarinfo in pbar:
                 with tar.extractfile(tarinfo) as f:
                     for json_data in iterate_jsonl(f):
-                        create_post(json_data, policy)
-                        #print(f"Created post {json_data['id']}")
+                        writer.add(json_data)
+                pbar.set_postfix(posts=writer.posts_written, rate=f"{writer.rate():.0f}/s")
+    writer.report()
+
+def iterate_source(source: str, read_method="r:gz"):
+    """
+    Iterate through a jsonl file or every jsonl member of a tarfile, streaming the archive once.
+    """
+    if source.endswith(".jsonl"):
+        yield from iterate_jsonl(source)
+        return
+    with tarfile.open(source, read_method) as tar:
+        for tarinfo in tar:
+            if tarinfo.isfile() and tarinfo.name.endswith(".jsonl"):
+                with tar.extractfile(tarinfo) as f:
+                    yield from iterate_jsonl(f)
+
+def _parse_worker(task_queue, result_queue, read_method, batch_size):
+    """
+    Worker process of create_db_parallel.
+    Parses (index, source) tasks from task_queue into batches of (post row, tags) and puts them on result_queue.
+    result_queue is bounded and only read while the writer is at one of this worker's sources, so put() blocks ahead of it.
+    """
+    while (task := task_queue.get()) is not None:
+        index, source = task
+        count = 0
+        batch = []
+        try:
+            for json_data in iterate_source(source, read_method):
+                batch.append(parse_post(json_data))
+                if len(batch) >= batch_size:
+                    result_queue.put(("batch", index, batch))
+                    count += len(batch)
+                    batch = []
+            if batch:
+                result_queue.put(("batch", index, batch))
+                count += len(batch)
+            result_queue.put(("done", index, count))
+        except Exception as e:
+            result_queue.put(("error", index, f"{type(e).__name__}: {e}"))
+
+def create_db_parallel(sources, policy="ignore", read_method="r:gz", workers=None, batch_size=1000, commit_every=100000, buffer_batches=4):
+    """
+    Create a database from jsonl files, folders of jsonl files and tarfiles with a pool of parser processes.
+    The workers decompress and parse whole sources into compact row tuples, this process is the only writer.
+        Policy can be 'ignore' or 'replace'
+        Batches are applied in source order, so duplicated ids resolve exactly as in a serial run.
+        Source i is parsed by worker i % workers into its own queue of at most buffer_batches batches,
+        the writer only reads the queue of the current source, so at most workers * buffer_batches batches wait in memory.
+    Returns the list of (source, error) that failed to parse.
+    """
+    global db
+    assert db is not None, "Database is not loaded"
+    all_sources = []
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                all_sources.extend(os.path.join(root, file) for file in files if file.endswith(".jsonl"))
+        else:
+            all_sources.append(source)
+    workers = min(workers or os.cpu_count() or 1, len(all_sources))
+    if workers == 0:
+        return []
+    context = multiprocessing.get_context()
+    task_queues = [context.Queue() for _ in range(workers)]
+    result_queues = [context.Queue(maxsize=buffer_batches) for _ in range(workers)]
+    for index, source in enumerate(all_sources):
+        task_queues[index % workers].put((index, source))
+    for task_queue in task_queues:
+        task_queue.put(None)
+    processes = [context.Process(target=_parse_worker, args=(task_queues[i], result_queues[i], read_method, batch_size), daemon=True)
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    errors = []
+    try:
+        with PostBatchWriter(policy, batch_size, commit_every) as writer:
+            pbar = tqdm(total=len(all_sources))
+            for index, source in enumerate(all_sources):
+                process, result_queue = processes[index % workers], result_queues[index % workers]
+                while True:
+                    try:
+                        kind, message_index, payload = result_queue.get(timeout=1)
+                    except queue.Empty:
+                        if process.is_alive():
+                            continue
+                        try:
+                            # the worker may have exited right after its last put
+                            kind, message_index, payload = result_queue.get(timeout=1)
+                        except queue.Empty:
+                            raise RuntimeError(f"Parser process of {source} exited with code {process.exitcode}") from None
+                    assert message_index == index, f"Parser sent source {message_index} while {index} was expected"
+                    if kind == "batch":
+                        for row, tags in payload:
+                            writer.add_parsed(row, tags)
+                        pbar.set_postfix(posts=writer.posts_written, rate=f"{writer.rate():.0f}/s")
+                        continue
+                    if kind == "error":
+                        print(f"Error while parsing {source}: {payload}")
+                        errors.append((source, payload))
+                    break
+                pbar.update(1)
+            pbar.close()
+    except BaseException:
+        for process in processes:
+            process.terminate()
+        raise
+    finally:
+        for process in processes:
+            process.join()
+    writer.report()
+    return errors
+
+def ingest_incremental(sources, policy="ignore", read_method="r:gz", batch_size=1000, commit_every=100000):
+    """
+    Ingest tarfiles, jsonl files and folders of jsonl files, applying only what changed since the last run.
+    Progress (archive, member, byte offset, max id) is stored in the IngestProgress table and committed together with the posts,
+    keyed by the absolute path of the archive or file, so files sharing a name in different folders never share progress:
+        - archives and files whose size and mtime are unchanged since they were finished are skipped without opening them
+        - finished tar members are skipped without being parsed (tarfile still inflates a gzip stream to step over them)
+        - interrupted members resume at the last committed byte offset
+        - members whose size or mtime changed are read again, with 'ignore' ids up to their previous max id are skipped
+        Policy can be 'ignore' or 'replace'
+    """
+    global db
+    assert db is not None and IngestProgress is not None, "Database is not loaded"
+    IngestProgress.create_table(safe=True)
+    known = {(progress.source, progress.member): progress for progress in IngestProgress.select()}
+    dirty = {}
+    skipped_sources = 0
+    skipped_members = 0
+
+    def save_progress():
+        for progress in dirty.values():
+            progress.updated_at = time.time()
+            progress.save()
+        dirty.clear()
+
+    def get_progress(source_key, member, size, mtime):
+        """
+        Returns (progress, previous max id if the member changed after being finished)
+        """
+        progress = known.get((source_key, member))
+        if progress is None:
+            progress = IngestProgress(source=source_key, member=member, member_size=size, member_mtime=mtime, offset=0, finished=False)
+            known[(source_key, member)] = progress
+            return progress, None
+        if progress.member_size == size and progress.member_mtime == mtime:
+            return progress, None
+        previous_max_id = progress.max_id if progress.finished else None
+        progress.member_size, progress.member_mtime = size, mtime
+        progress.offset, progress.max_id, progress.finished = 0, None, False
+        return progress, previous_max_id
+
+    def ingest_member(progress, f, previous_max_id):
+        key = (progress.source, progress.member)
+        if progress.offset:
+            f.seek(progress.offset)
+        for json_data, offset in iterate_jsonl(f, with_offsets=True, start_offset=progress.offset):
+            progress.offset = offset
+            dirty[key] = progress
+            post_id = json_data.get("id")
+            if post_id is None:
+                continue
+            progress.max_id = max(progress.max_id or post_id, post_id)
+            if previous_max_id is not None and post_id <= previous_max_id and policy == "ignore":
+                continue
+            writer.add(json_data)
+        progress.finished = True
+        dirty[key] = progress
+
+    all_sources = []
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                all_sources.extend(os.path.join(root, file) for file in sorted(files) if file.endswith(".jsonl"))
+        else:
+            all_sources.append(source)
+    with PostBatchWriter(policy, batch_size, commit_every) as writer:
+        writer.before_commit = save_progress
+        pbar = tqdm(all_sources)
+        for source in pbar:
+            stat = os.stat(source)
+            source_key = os.path.abspath(source)
+            source_progress, previous_max_id = get_progress(source_key, "", stat.st_size, int(stat.st_mtime))
+            if source_progress.finished:
+                skipped_sources += 1
+                continue
+            if source.endswith(".jsonl"):
+                with open(source, "rb") as f:
+                    ingest_member(source_progress, f, previous_max_id)
+            else:
+                with tarfile.open(source, read_method) as tar:
+                    for tarinfo in tar:
+                        if not (tarinfo.isfile() and tarinfo.name.endswith(".jsonl")):
+                            continue
+                        progress, previous_max_id = get_progress(source_key, tarinfo.name, tarinfo.size, int(tarinfo.mtime))
+                        if progress.finished:
+                            skipped_members += 1
+                            continue
+                        with tar.extractfile(tarinfo) as f:
+                            ingest_member(progress, f, previous_max_id)
+                        pbar.set_postfix(posts=writer.posts_written, rate=f"{writer.rate():.0f}/s")
+                source_progress.finished = True
+                dirty[(source_key, "")] = source_progress
+            pbar.set_postfix(posts=writer.posts_written, rate=f"{writer.rate():.0f}/s")
+    writer.report()
+    print(f"Skipped {skipped_sources} unchanged sources and {skipped_members} finished members")
 
 def sanity_check(order="random"):
     """
     Print out a random post and its informations
     """
     if order == "random":
-        random_post = Post.select().order_by(fn.Random()).limit(1).get()
+        random_post = PostSampler({"Post": Post}).sample(1)[0] # probes random ids instead of sorting the table
     else:
         random_post = Post.select().limit(1).get()
     print(f"Post id : {random_post.id}")
@@ -197,12 +713,14 @@ def sanity_check(order="random"):
     print(f"Post bit_flags: {random_post.bit_flags}")
 
 if __name__ == "__main__":
-    db_dict = load_db("gelbooru2024-02.db")
+    db_dict = load_db("gelbooru2024-02.db", bulk_load=True)
     Post, Tag, PostTagRelation = db_dict["Post"], db_dict["Tag"], db_dict["PostTagRelation"]
     db = db_dict["db"]
     LocalPost = db_dict["LocalPost"]
+    IngestProgress = db_dict["IngestProgress"]
     
     #read_and_create_posts(r"C:\sqlite\0_99.jsonl")
     #create_db_from_folder(r'D:\danbooru-0319') # if you have a folder of jsonl files
-    for i in range(2,10):
-        create_db_from_tarfile(rf"G:\gelboorupost\{i}M.tar.gz")
+    #ingest_incremental([rf"G:\gelboorupost\{i}M.tar.gz" for i in range(2,10)]) # daily refresh, only applies what changed
+    create_db_parallel([rf"G:\gelboorupost\{i}M.tar.gz" for i in range(2,10)])
+    db_dict["finish_bulk_load"]()
@@ -1,7 +1,7 @@
-from db import load_db, GELBOORU_KEYS_TO_DANBOORU
+from db import load_db, created_at_to_day, GELBOORU_KEYS_TO_DANBOORU
 import os
-import datetime
 import json
+import numpy as np
 from tqdm import tqdm
 def sanity_check(random_post):
     """
@@ -47,43 +47,64 @@ DanbooruPost, DanbooruTag, DanbooruPostTagRelation = dict_1["Post"], dict_1["Tag
 
 GelbooruPost, GelbooruTag, GelbooruPostTagRelation = dict_2["Post"], dict_2["Tag"], dict_2["PostTagRelation"]
 
-def find_matching():
-    selector = DanbooruPost.select().where(DanbooruPost.source.is_null(False) & (DanbooruPost.large_file_url.is_null(True)
-                                                                                )).order_by(DanbooruPost.id.desc()).where(DanbooruPost.id < 6000000)
+def dimension_day_keys(width, height, day):
+    """
+    Packs (width, height, day) into sortable int64 keys, 21 bits each
+    """
+    return (np.asarray(width, dtype=np.int64) << 42) | (np.asarray(height, dtype=np.int64) << 21) | np.asarray(day, dtype=np.int64)
+
+def load_gelbooru_keys(batch_size=1000000):
+    """
+    Returns (sorted keys, post ids in key order) of every gelbooru post
+    """
+    keys, ids = [], []
+    cursor = GelbooruPost._meta.database.execute_sql(f'SELECT "id", "image_width", "image_height", "created_at" FROM "{GelbooruPost._meta.table_name}"')
+    pbar = tqdm(desc="Loading gelbooru keys")
+    while rows := cursor.fetchmany(batch_size):
+        rows = [(post_id, width, height, created_at_to_day(created_at)) for post_id, width, height, created_at in rows]
+        rows = np.array([row for row in rows if None not in row], dtype=np.int64).reshape(-1, 4)
+        keys.append(dimension_day_keys(rows[:, 1], rows[:, 2], rows[:, 3]))
+        ids.append(rows[:, 0])
+        pbar.update(len(rows))
+    pbar.close()
+    keys = np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64)
+    ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+    order = np.argsort(keys, kind="stable")
+    return keys[order], ids[order]
+
+def find_matching(day_range=2, output_file="found_dict.json"):
+    """
+    Finds gelbooru posts with the same width and height as danbooru candidates, created within day_range days before
+    and day_range - 1 days after (the window of the old per-candidate created_at string comparison).
+    Both sides are loaded once and joined with a sorted merge over (width, height, day) keys.
+    """
+    selector = DanbooruPost.select(DanbooruPost.id, DanbooruPost.image_width, DanbooruPost.image_height, DanbooruPost.created_at).where(
+        DanbooruPost.source.is_null(False) & (DanbooruPost.large_file_url.is_null(True))).where(DanbooruPost.id < 6000000)
 
     # find if PostTagRelation has any of the external keys -> if so, find the post and print it
-    selector = selector.join(DanbooruPostTagRelation).join(DanbooruTag).where(DanbooruTag.name << external_keys_to_find)
+    selector = selector.join(DanbooruPostTagRelation).join(DanbooruTag).where(DanbooruTag.name << external_keys_to_find).distinct()
 
     # search for the post in gelbooru
     # if "width" and "height" is identical, we can assume that the post is the same
-    # get list of posts with the same width and height + maybe created_at "date" range in 1-2 days
+    # get list of posts with the same width and height + created_at "date" range in 1-2 days
 
     # created_at is 2024-03-18T23:57:33.245-04:00 like string
     # gelbooru created_at is saved as Fri Jan 20 12:19:14 -0600 2023
-    # we need to convert the string to a datetime object
-
-    def convert_to_day(date, offset): # to 2024-03-18
-        # reads date string, adds offset days and returns the date in the format "2024-03-18"
-        return (datetime.datetime.strptime(date, "%Y-%m-%dT%H:%M:%S.%f%z") + datetime.timedelta(days=offset)).strftime("%Y-%m-%d")
-
-    def convert_to_day_gelbooru(date):
-        return datetime.datetime.strptime(date, "%a %b %d %H:%M:%S %z %Y").strftime("%Y-%m-%d")
+    # both are converted to days since epoch (created_at_to_day)
+    candidates = [(post_id, width, height, created_at_to_day(created_at)) for post_id, width, height, created_at in tqdm(selector.tuples(), desc="Loading danbooru candidates")]
+    candidates = np.array([row for row in candidates if None not in row], dtype=np.int64).reshape(-1, 4)
+    candidates = candidates[np.argsort(-candidates[:, 0], kind="stable")] # id descending
+    gelbooru_keys, gelbooru_ids = load_gelbooru_keys()
+    low = np.searchsorted(gelbooru_keys, dimension_day_keys(candidates[:, 1], candidates[:, 2], candidates[:, 3] - day_range), side="left")
+    high = np.searchsorted(gelbooru_keys, dimension_day_keys(candidates[:, 1], candidates[:, 2], candidates[:, 3] + day_range), side="left")
     found_dict = {}
-    pbar = tqdm(selector, total=selector.count())
-    total_found = 0
-    for result in pbar:
-        
-        finder = GelbooruPost.select(GelbooruPost.id).where(GelbooruPost.image_width == result.image_width, GelbooruPost.image_height == result.image_height).where(
-            (GelbooruPost.created_at > convert_to_day(result.created_at, -2)) & (GelbooruPost.created_at < convert_to_day(result.created_at, 2)))
-        if finder.exists():
-            found_dict[result.id] = []
-            for found in finder:
-                found_dict[result.id].append(found.id)
-            total_found += 1
-            pbar.set_postfix({"found": total_found})
+    for index in np.flatnonzero(high > low):
+        found_dict[int(candidates[index, 0])] = gelbooru_ids[low[index]:high[index]].tolist()
+    print(f"Found {len(found_dict)} of {len(candidates)} candidates")
     # save to file
-    with open("found_dict.json", 'w') as f:
+    with open(output_file, 'w') as f:
         f.write(json.dumps(found_dict))
+    return found_dict
 
 if __name__ == "__main__":
     find_matching()
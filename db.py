@@ -4,6 +4,15 @@ import jsonlines
 import json
 import sqlite3
 import os
+import time
+import calendar
+import datetime
+import itertools
+import pathlib
+import threading
+from playhouse.pool import PooledSqliteDatabase
+import numpy as np
+from tqdm import tqdm
 
 GELBOORU_KEYS_TO_DANBOORU = {
     "creator_id": "uploader_id",
@@ -18,12 +27,231 @@ GELBOORU_KEYS_TO_DANBOORU = {
 
 DANBOORU_KEYS_TO_GELBOORU = {value: key for key, value in GELBOORU_KEYS_TO_DANBOORU.items()}
 
+TAG_BLOB_DTYPE = np.dtype("<i4") # PostTagBlob.tag_ids packing
 
-def load_db(db_file: str, table_names = ["post", "tag", "posttagrelation", "localpost"]) -> dict:
+MONTHS = {month: index for index, month in enumerate(calendar.month_abbr) if month}
+
+def parse_created_at(created_at: str):
+    """
+    Returns the epoch seconds of a Post.created_at string, or None if it cannot be parsed.
+    Handles danbooru ISO strings (2024-03-18T23:57:33.245-04:00) and gelbooru strings (Fri Jan 20 12:19:14 -0600 2023).
+    """
+    if not created_at:
+        return None
+    try:
+        if created_at[0].isdigit():
+            date = datetime.datetime.fromisoformat(created_at)
+            if date.tzinfo is None:
+                date = date.replace(tzinfo=datetime.timezone.utc)
+            return int(date.timestamp())
+        # gelbooru, parsed by hand since strptime is slow
+        _, month, day, clock, offset, year = created_at.split(" ")
+        hour, minute, second = clock.split(":")
+        offset_seconds = (int(offset[1:3]) * 3600 + int(offset[3:5]) * 60) * (-1 if offset[0] == "-" else 1)
+        return calendar.timegm((int(year), MONTHS[month], int(day), int(hour), int(minute), int(second))) - offset_seconds
+    except (ValueError, KeyError, IndexError):
+        return None
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+def created_at_to_day(created_at: str):
+    """
+    Returns the calendar day of a Post.created_at string as days since 1970-01-01, or None if it cannot be parsed.
+    The day is the one written in the string (its own timezone), like strftime("%Y-%m-%d") on the parsed date.
+    """
+    if not created_at:
+        return None
+    try:
+        if created_at[0].isdigit():
+            year, month, day = int(created_at[0:4]), int(created_at[5:7]), int(created_at[8:10])
+        else:
+            _, month_name, day, _, _, year = created_at.split(" ")
+            year, month, day = int(year), MONTHS[month_name], int(day)
+        return datetime.date(year, month, day).toordinal() - EPOCH_ORDINAL
+    except (ValueError, KeyError, IndexError):
+        return None
+
+# pragmas for load_db(..., bulk_load=True), durability is traded for insert speed until finish_bulk_load()
+BULK_LOAD_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "off",
+    "cache_size": -1024 * 1024, # in KiB, 1GiB
+    "mmap_size": 1 << 30,
+    "temp_store": "memory",
+}
+# PRAGMA user_version while a bulk load has dropped the indexes, load_db rebuilds them if finish_bulk_load() never ran
+BULK_LOAD_MARKER = 0x42554C4B
+
+# pragmas of the read-only connections of load_db(..., read_only=True)
+READ_POOL_PRAGMAS = {
+    "query_only": 1,
+    "mmap_size": 1 << 30,
+    "cache_size": -64 * 1024, # in KiB per connection, 64MiB
+    "temp_store": "memory",
+}
+
+class SqliteReadOnlyDatabase(SqliteDatabase):
+    """
+    Opens the database file through a mode=ro URI, so connections never take the write lock.
+    immutable=True also skips file locking and change detection, only use it when no process writes to the file.
+    """
+    def __init__(self, database, *args, immutable=False, **kwargs):
+        self.immutable = immutable
+        super().__init__(database, *args, **kwargs)
+
+    def _connect(self):
+        uri = pathlib.Path(os.path.abspath(self.database)).as_uri() + "?mode=ro" + ("&immutable=1" if self.immutable else "")
+        conn = sqlite3.connect(uri, uri=True, timeout=self._timeout, isolation_level=None, check_same_thread=False)
+        try:
+            self._add_conn_hooks(conn)
+        except:
+            conn.close()
+            raise
+        return conn
+
+class SqliteReadPoolDatabase(PooledSqliteDatabase, SqliteReadOnlyDatabase):
+    """
+    Pool of at most max_connections read-only connections, used by load_db(..., read_only=True).
+    A thread checks a connection out on its first query and returns it with db.close(),
+    workers should wrap each unit of work in `with db.connection_context():`.
+    After a fork the child drops the inherited connections and opens its own.
+    """
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self.pid = os.getpid()
+
+    def _check_fork(self):
+        if self.pid != os.getpid():
+            self._pool_lock = threading.RLock()
+            self._connections = []
+            self._in_use = {}
+            self._state.reset()
+            self.pid = os.getpid()
+
+    def connect(self, reuse_if_open=False):
+        self._check_fork()
+        return super().connect(reuse_if_open)
+
+    def cursor(self, *args, **kwargs):
+        self._check_fork()
+        return super().cursor(*args, **kwargs)
+
+class SqliteSharedMemDatabase(SqliteDatabase):
+    """
+    Database file copied into a shared-cache in-memory database, used by load_db(..., in_memory=True).
+    Every thread gets its own connection to the same in-memory copy. With read_only_threads=True only the
+    thread that created the database can write, the others get query_only connections that do not wait for its locks.
+    save() writes the copy back with paged backup steps and skips the write when nothing changed.
+    """
+    _counter = itertools.count()
+
+    def __init__(self, database, *args, read_only_threads=True, pages=4096, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self.memory_uri = f"file:booru_mem_{os.getpid()}_{next(self._counter)}?mode=memory&cache=shared"
+        self.read_only_threads = read_only_threads
+        self.pages = pages
+        self.owner_thread = threading.get_ident()
+        # keeps the in-memory database alive, and reads PRAGMA data_version for the commits of the other connections
+        self.keeper = sqlite3.connect(self.memory_uri, uri=True, check_same_thread=False)
+        self.keeper_lock = threading.Lock()
+        self.saved_version = None
+        if os.path.exists(database):
+            self.reload()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.memory_uri, uri=True, timeout=self._timeout, isolation_level=None, check_same_thread=False)
+        try:
+            self._add_conn_hooks(conn)
+        except:
+            conn.close()
+            raise
+        if self.read_only_threads and threading.get_ident() != self.owner_thread:
+            conn.execute("PRAGMA query_only = 1")
+            conn.execute("PRAGMA read_uncommitted = 1")
+        return conn
+
+    def _data_version(self):
+        return self.keeper.execute("PRAGMA data_version").fetchone()[0]
+
+    def _backup(self, source, target, desc):
+        pbar = tqdm(desc=desc, unit="page")
+        def progress(status, remaining, total):
+            pbar.total = total
+            pbar.n = total - remaining
+            pbar.refresh()
+        try:
+            source.backup(target, pages=self.pages, progress=progress)
+        finally:
+            pbar.close()
+
+    def reload(self, dbname=None):
+        """
+        Copies the database file into memory, replacing the in-memory copy
+        """
+        load_conn = sqlite3.connect(dbname or self.database)
+        try:
+            with self.keeper_lock:
+                self._backup(load_conn, self.keeper, "Loading into memory")
+                self.saved_version = self._data_version()
+        finally:
+            load_conn.close()
+
+    def is_dirty(self):
+        """
+        Returns True if a connection committed since the last load or save
+        """
+        with self.keeper_lock:
+            return self.saved_version is None or self._data_version() != self.saved_version
+
+    def save(self, dbname=None, force=False):
+        """
+        Writes the in-memory copy to dbname (default: the database file), self.pages pages per step so readers are not blocked.
+        Returns False if nothing changed since the last save.
+        """
+        if not force and dbname is None and not self.is_dirty():
+            return False
+        save_conn = sqlite3.connect(dbname or self.database)
+        try:
+            with self.keeper_lock:
+                version = self._data_version()
+                self._backup(self.keeper, save_conn, "Saving from memory")
+                if dbname is None:
+                    self.saved_version = version
+        finally:
+            save_conn.close()
+        return True
+
+    def close_memory(self):
+        """
+        Closes every connection, the in-memory copy is freed (save() first to keep changes)
+        """
+        self.close()
+        with self.keeper_lock:
+            self.keeper.close()
+
+def load_db(db_file: str, table_names = ["post", "tag", "posttagrelation", "localpost", "posttagblob", "ingestprogress"], bulk_load=False, tag_storage="relation", in_memory=False,
+            read_only=False, pool_size=None, immutable=False, verbose=True) -> dict:
     """
     Return a dictionary with the database objects.
     This allows multiple databases to be loaded in one program.
+    bulk_load=True applies BULK_LOAD_PRAGMAS and drops the secondary indexes (including the unique index on Tag.name)
+    except PostTagRelation.post, which 'replace' ingestion deletes by.
+    call the returned finish_bulk_load() after loading to rebuild them and run ANALYZE.
+    If it never ran (BULK_LOAD_MARKER is still set or indexes are missing), the next load_db rebuilds them, read_only raises.
+    Only load through create_db.PostBatchWriter in this mode, it keeps tag names unique without the index.
+    tag_storage="blob" makes Post.tag_list read the packed tag ids of PostTagBlob (see rebuild_tag_storage),
+    posts without a blob fall back to PostTagRelation.
+    in_memory=True copies the file into a shared in-memory database (see SqliteSharedMemDatabase),
+    other threads read it through query_only connections, call db.save() to write changes back to the file.
+    read_only=True opens a SqliteReadPoolDatabase of pool_size (default: cpu count) read-only connections
+    with READ_POOL_PRAGMAS, and never changes the schema. immutable=True adds immutable=1 to the URIs.
+    verbose=False silences the prints.
     """
+    if read_only and (bulk_load or in_memory):
+        raise ValueError("read_only cannot be combined with bulk_load or in_memory")
+    if read_only and not os.path.exists(db_file):
+        raise FileNotFoundError(f"{db_file} does not exist, read_only mode cannot create it")
+    log = print if verbose else lambda *args, **kwargs: None
     tag_cache_map = {}
     class BaseModel(Model):
         class Meta:
@@ -55,6 +283,7 @@ def load_db(db_file: str, table_names = ["post", "tag", "posttagrelation", "loca
         # "id", "created_at", "uploader_id", "source", "md5", "parent_id", "has_children", "is_deleted", "is_banned", "pixiv_id", "has_active_children", "bit_flags", "has_large", "has_visible_children", "image_width", "image_height", "file_size", "file_ext", "rating", "score", "up_score", "down_score", "fav_count", "file_url", "large_file_url", "preview_file_url"
         id = IntegerField(primary_key=True)
         created_at = CharField()
+        created_at_epoch = BigIntegerField(null=True, index=True) # parse_created_at(created_at), see backfill_created_at_epoch
         uploader_id = IntegerField() # creator_id in gelbooru
         source = CharField()
         md5 = CharField(null=True)
@@ -86,6 +315,8 @@ def load_db(db_file: str, table_names = ["post", "tag", "posttagrelation", "loca
 
         _tags: ManyToManyField = None # set by tags.bind
         _tags_cache = None
+        _tags_by_type = None # tag type -> tuple of tags, built once from tag_list
+        _tag_blob_ready = False # PostTagBlob table exists
 
         @property
         def tag_count(self):
@@ -111,35 +342,60 @@ def load_db(db_file: str, table_names = ["post", "tag", "posttagrelation", "loca
         def tag_count_meta(self):
             return len(self.tag_list_meta) if self.tag_list else 0
 
+        @property
+        def tag_ids(self):
+            """
+            Tag ids from the packed PostTagBlob, or None if the post has no blob
+            """
+            blob = PostTagBlob.select(PostTagBlob.tag_ids).where(PostTagBlob.post == self.id).scalar()
+            if blob is None:
+                return None
+            return np.frombuffer(blob, dtype=TAG_BLOB_DTYPE)
+
         @property
         def tag_list(self):
             if self._tags_cache is None:
-                self._tags_cache = list(self._tags)
+                tag_ids = self.tag_ids if tag_storage == "blob" and self._tag_blob_ready else None
+                if tag_ids is not None:
+                    self._tags_cache = get_tags_by_ids(tag_ids.tolist())
+                else:
+                    self._tags_cache = list(self._tags)
             return self._tags_cache
 
+        def tags_of_type(self, tag_type):
+            """
+            Returns the tags of the given type as a tuple
+            """
+            if self._tags_by_type is None:
+                tags_by_type = {}
+                for tag in self.tag_list:
+                    tags_by_type.setdefault(tag.type, []).append(tag)
+                self._tags_by_type = {key: tuple(value) for key, value in tags_by_type.items()}
+            return self._tags_by_type.get(tag_type, ())
+
         @property
         def tag_list_general(self):
-            return [tag for tag in self.tag_list if tag.type == "general"]
+            return self.tags_of_type("general")
 
         @property
         def tag_list_artist(self):
-            return [tag for tag in self.tag_list if tag.type == "artist"]
+            return self.tags_of_type("artist")
 
         @property
         def tag_list_character(self):
-            return [tag for tag in self.tag_list if tag.type == "character"]
+            return self.tags_of_type("character")
 
         @property
         def tag_list_copyright(self):
-            return [tag for tag in self.tag_list if tag.type == "copyright"]
+            return self.tags_of_type("copyright")
 
         @property
         def tag_list_meta(self):
-            return [tag for tag in self.tag_list if tag.type == "meta"]
+            return self.tags_of_type("meta")
 
         @property
         def tag_list_unknown(self):
-            return [tag for tag in self.tag_list if tag.type == "unknown"]
+            return self.tags_of_type("unknown")
 
 
     class Tag(BaseModel):# table name is tags
@@ -169,6 +425,16 @@ def load_db(db_file: str, table_names = ["post", "tag", "posttagrelation", "loca
             tag_cache_map[tag_id] = Tag.get_by_id(tag_id)
         return tag_cache_map[tag_id]
 
+    def get_tags_by_ids(tag_ids):
+        """
+        Returns the tags in the order of tag_ids, fetching the uncached ones in one query.
+        """
+        missing = list({tag_id for tag_id in tag_ids if tag_id not in tag_cache_map})
+        for chunk in chunked(missing, 30000):
+            for tag in Tag.select().where(Tag.id.in_(chunk)):
+                tag_cache_map[tag.id] = tag
+        return [tag_cache_map[tag_id] for tag_id in tag_ids if tag_id in tag_cache_map]
+
     class PostTagRelation(BaseModel):
         class Meta:
             db_table = table_names[2]
@@ -189,34 +455,243 @@ def load_db(db_file: str, table_names = ["post", "tag", "posttagrelation", "loca
         def __repr__(self):
             return f"<LocalPost|#{self.id}|{self.filepath}|{self.latentpath}|{self.post}>"
 
+    def prefetch_tags(posts):
+        """
+        Load the tags of many posts at once and attach them, so tag_list and tag_list_* do not query per post.
+        posts can be a Post select or an iterable of posts, the list of posts is returned.
+        Uses one relation (or blob) query per 30000 posts, tags are shared through the tag id cache.
+        """
+        posts = list(posts)
+        tag_ids_by_post = {post.id: [] for post in posts}
+        post_ids = list(tag_ids_by_post)
+        remaining = post_ids
+        if tag_storage == "blob" and Post._tag_blob_ready:
+            remaining = []
+            for chunk in chunked(post_ids, 30000):
+                blobs = dict(PostTagBlob.select(PostTagBlob.post, PostTagBlob.tag_ids).where(PostTagBlob.post.in_(chunk)).tuples())
+                for post_id in chunk:
+                    if post_id in blobs:
+                        tag_ids_by_post[post_id] = np.frombuffer(blobs[post_id], dtype=TAG_BLOB_DTYPE).tolist()
+                    else:
+                        remaining.append(post_id)
+        for chunk in chunked(remaining, 30000):
+            query = PostTagRelation.select(PostTagRelation.post, PostTagRelation.tag).where(PostTagRelation.post.in_(chunk)).tuples()
+            for post_id, tag_id in query:
+                tag_ids_by_post[post_id].append(tag_id)
+        get_tags_by_ids({tag_id for tag_ids in tag_ids_by_post.values() for tag_id in tag_ids})
+        for post in posts:
+            post._tags_cache = [tag_cache_map[tag_id] for tag_id in tag_ids_by_post[post.id] if tag_id in tag_cache_map]
+            post._tags_by_type = None
+        return posts
+
+    class PostTagBlob(BaseModel):
+        """
+        Optional denormalized copy of PostTagRelation, tag ids of a post packed as little-endian int32
+        """
+        class Meta:
+            db_table = table_names[4] if len(table_names) > 4 else "posttagblob"
+        post = ForeignKeyField(Post, primary_key=True, backref="tag_blob")
+        tag_ids = BlobField()
+
+    class IngestProgress(BaseModel):
+        """
+        Per source progress of create_db.ingest_incremental, member is "" for the archive or file itself
+        """
+        class Meta:
+            db_table = table_names[5] if len(table_names) > 5 else "ingestprogress"
+            indexes = ((("source", "member"), True),)
+        source = CharField()
+        member = CharField()
+        member_size = IntegerField()
+        member_mtime = IntegerField()
+        offset = IntegerField(default=0) # bytes of the member already applied
+        max_id = IntegerField(null=True)
+        finished = BooleanField(default=False)
+        updated_at = FloatField(null=True)
+
     tags = ManyToManyField(Tag, backref="_posts", through_model=PostTagRelation)
     tags.bind(Post, "_tags", set_attribute=True)
     file_exists = os.path.exists(db_file)
-    db = SqliteDatabase(db_file)
+    if read_only:
+        db = SqliteReadPoolDatabase(db_file, max_connections=pool_size or os.cpu_count(), timeout=30, immutable=immutable, pragmas=READ_POOL_PRAGMAS)
+    elif in_memory:
+        db = SqliteSharedMemDatabase(db_file, pragmas=BULK_LOAD_PRAGMAS if bulk_load else None)
+    else:
+        db = SqliteDatabase(db_file, pragmas=BULK_LOAD_PRAGMAS if bulk_load else None)
     Post._meta.database = db
     Tag._meta.database = db
     PostTagRelation._meta.database = db
     LocalPost._meta.database = db
+    PostTagBlob._meta.database = db
+    IngestProgress._meta.database = db
     db.connect()
-    print("Database connected.")
+    log("Database connected.")
     # print all tables
-    print(db.get_tables())
+    log(db.get_tables())
     if not file_exists:
         db.create_tables([Post, Tag, PostTagRelation])
         db.create_tables([LocalPost])
         db.commit()
-        print("Database initialized.")
+        log("Database initialized.")
     assert db is not None, "Database is not loaded"
+    Post._tag_blob_ready = PostTagBlob.table_exists()
+    if file_exists and "created_at_epoch" not in {column.name for column in db.get_columns(Post._meta.table_name)}:
+        # older database, backfill_created_at_epoch adds the column
+        Post._meta.remove_field("created_at_epoch")
+
+    def select_created_between(start, end):
+        """
+        Returns a Post select of posts created in [start, end), given as epoch seconds or aware datetimes.
+        Range-scans the created_at_epoch index.
+        """
+        if "created_at_epoch" not in Post._meta.fields:
+            raise RuntimeError("created_at_epoch column does not exist, run backfill_created_at_epoch first")
+        if isinstance(start, datetime.datetime):
+            start = int(start.timestamp())
+        if isinstance(end, datetime.datetime):
+            end = int(end.timestamp())
+        return Post.select().where((Post.created_at_epoch >= start) & (Post.created_at_epoch < end))
+    indexed_models = [Post, Tag, PostTagRelation, LocalPost]
+
+    def missing_indexes():
+        """
+        Returns the names of the model indexes that are missing from the database
+        """
+        missing = []
+        for model in indexed_models:
+            if not db.table_exists(model._meta.table_name):
+                continue
+            existing = {index.name for index in db.get_indexes(model._meta.table_name)}
+            missing.extend(index._name for index in model._meta.fields_to_index() if index._name not in existing)
+        return missing
+
+    def finish_bulk_load():
+        """
+        Rebuild the secondary indexes, run ANALYZE and restore durable pragmas.
+        Does nothing when no bulk load is in progress and every index exists, so it can be called again.
+        """
+        if db.pragma("user_version") != BULK_LOAD_MARKER and not missing_indexes():
+            return
+        for model in indexed_models:
+            if not db.table_exists(model._meta.table_name):
+                continue
+            start_time = time.time()
+            model._schema.create_indexes(safe=True)
+            log(f"Bulk load: built {model._meta.table_name} indexes in {time.time() - start_time:.2f}s")
+        start_time = time.time()
+        db.execute_sql("ANALYZE")
+        log(f"Bulk load: ANALYZE in {time.time() - start_time:.2f}s")
+        start_time = time.time()
+        db.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        db.pragma("journal_mode", "delete")
+        db.pragma("synchronous", "full")
+        db.pragma("user_version", 0)
+        log(f"Bulk load: checkpoint in {time.time() - start_time:.2f}s")
+
+    if bulk_load:
+        start_time = time.time()
+        db.pragma("user_version", BULK_LOAD_MARKER) # set before any index is dropped
+        # 'replace' deletes the relations of every flushed batch by post id, without the index each delete scans the table
+        kept = {index._name for index in PostTagRelation._meta.fields_to_index() if any(field is PostTagRelation.post for field in index._expressions)}
+        for model in indexed_models:
+            for index in db.get_indexes(model._meta.table_name):
+                if index.name not in kept:
+                    db.execute_sql(f'DROP INDEX IF EXISTS "{index.name}"')
+        log(f"Bulk load: dropped secondary indexes in {time.time() - start_time:.2f}s")
+    elif db.pragma("user_version") == BULK_LOAD_MARKER or missing_indexes():
+        if read_only:
+            raise RuntimeError(f"{db_file} has an unfinished bulk load or missing indexes, open it once without read_only to rebuild them")
+        log("Unfinished bulk load or missing indexes, rebuilding them")
+        finish_bulk_load()
+    if read_only:
+        db.close() # back to the pool, each thread checks out its own connection
+
     return {
         "Post": Post,
         "Tag": Tag,
         "PostTagRelation": PostTagRelation,
         "LocalPost": LocalPost,
+        "PostTagBlob": PostTagBlob,
+        "IngestProgress": IngestProgress,
         "tags": tags,
         "get_tag_by_id": get_tag_by_id,
+        "get_tags_by_ids": get_tags_by_ids,
+        "prefetch_tags": prefetch_tags,
+        "select_created_between": select_created_between,
         "db": db,
+        "finish_bulk_load": finish_bulk_load,
     }
 
+def rebuild_tag_storage(db_dict: dict, source="relation", batch_size=10000):
+    """
+    Rebuild one tag representation from the other.
+        source="relation" rebuilds PostTagBlob from PostTagRelation,
+        source="blob" rebuilds PostTagRelation from PostTagBlob, the relations of posts without a blob are kept.
+    Rows are streamed in post id order, so memory stays bounded.
+    """
+    db, Post, PostTagRelation, PostTagBlob = db_dict["db"], db_dict["Post"], db_dict["PostTagRelation"], db_dict["PostTagBlob"]
+    relation_table, blob_table = PostTagRelation._meta.table_name, PostTagBlob._meta.table_name
+    start_time = time.time()
+    written = 0
+    with db.atomic():
+        db.create_tables([PostTagBlob])
+        if source == "relation":
+            db.execute_sql(f'DELETE FROM "{blob_table}"')
+            insert_sql = f'INSERT INTO "{blob_table}" ("post_id", "tag_ids") VALUES (?, ?)'
+            cursor = db.execute_sql(f'SELECT "post_id", "tag_id" FROM "{relation_table}" ORDER BY "post_id", "id"')
+            rows = []
+            current_post, current_tags = None, []
+            for post_id, tag_id in cursor:
+                if post_id != current_post:
+                    if current_tags:
+                        rows.append((current_post, np.array(current_tags, dtype=TAG_BLOB_DTYPE).tobytes()))
+                    current_post, current_tags = post_id, []
+                current_tags.append(tag_id)
+                if len(rows) >= batch_size:
+                    db.cursor().executemany(insert_sql, rows)
+                    written += len(rows)
+                    rows = []
+            if current_tags:
+                rows.append((current_post, np.array(current_tags, dtype=TAG_BLOB_DTYPE).tobytes()))
+            db.cursor().executemany(insert_sql, rows)
+            written += len(rows)
+        elif source == "blob":
+            db.execute_sql(f'DELETE FROM "{relation_table}" WHERE "post_id" IN (SELECT "post_id" FROM "{blob_table}")')
+            insert_sql = f'INSERT INTO "{relation_table}" ("post_id", "tag_id") VALUES (?, ?)'
+            cursor = db.execute_sql(f'SELECT "post_id", "tag_ids" FROM "{blob_table}" ORDER BY "post_id"')
+            while blobs := cursor.fetchmany(batch_size):
+                rows = [(post_id, tag_id) for post_id, blob in blobs for tag_id in np.frombuffer(blob, dtype=TAG_BLOB_DTYPE).tolist()]
+                db.cursor().executemany(insert_sql, rows)
+                written += len(blobs)
+        else:
+            raise ValueError(f"Unknown source {source}, must be 'relation' or 'blob'")
+    Post._tag_blob_ready = True
+    print(f"Rebuilt tag storage from {source} for {written} posts in {time.time() - start_time:.1f}s")
+
+def backfill_created_at_epoch(db_dict: dict, batch_size=100000):
+    """
+    Adds the created_at_epoch column and its index to an existing database and fills it from created_at.
+    Rows are updated in id ranges that are committed one by one, so an interrupted backfill can simply be run again.
+    """
+    db, Post = db_dict["db"], db_dict["Post"]
+    table = Post._meta.table_name
+    start_time = time.time()
+    if "created_at_epoch" not in {column.name for column in db.get_columns(table)}:
+        db.execute_sql(f'ALTER TABLE "{table}" ADD COLUMN "created_at_epoch" INTEGER')
+    if "created_at_epoch" not in Post._meta.fields:
+        Post._meta.add_field("created_at_epoch", BigIntegerField(null=True, index=True))
+    db.connection().create_function("parse_created_at", 1, parse_created_at, deterministic=True)
+    min_id, max_id = db.execute_sql(f'SELECT MIN("id"), MAX("id") FROM "{table}"').fetchone()
+    updated = 0
+    if min_id is not None:
+        for start in tqdm(range(min_id, max_id + 1, batch_size), desc="Backfilling created_at_epoch"):
+            with db.atomic():
+                cursor = db.execute_sql(f'UPDATE "{table}" SET "created_at_epoch" = parse_created_at("created_at") '
+                                        f'WHERE "id" >= ? AND "id" < ? AND "created_at_epoch" IS NULL', (start, start + batch_size))
+                updated += cursor.rowcount
+    Post._schema.create_indexes(safe=True)
+    print(f"Backfilled created_at_epoch for {updated} posts in {time.time() - start_time:.1f}s")
+
 if __name__ == "__main__":
     test_tarfile = r'G:\gelboorupost\0M.tar.gz'
     # get first jsonl file from tarfile
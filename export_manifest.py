@@ -0,0 +1,197 @@
+"""
+Exports posts with their tags by category to sharded training manifests.
+Each shard is a range of post ids written by one worker process as manifest-{shard}.jsonl (or .parquet with pyarrow).
+manifest.json records the shard bounds and settings, a rerun skips the finished shards only if both are unchanged.
+Usage:
+    python export_manifest.py gelbooru2024-02.db manifests --workers 8
+    python export_manifest.py gelbooru2024-02.db manifests --restart # discards a previous export
+    export_manifest("gelbooru2024-02.db", "manifests", ratings=["general"], min_score=10, output_format="parquet")
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from tqdm import tqdm
+from db import load_db
+from utils.downloader import get_post_url
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+TAG_CATEGORIES = ["general", "artist", "character", "copyright", "meta", "unknown"]
+INTEGER_COLUMNS = ["id", "score", "fav_count", "image_width", "image_height"]
+STRING_COLUMNS = ["md5", "file_url", "file_ext", "rating", "created_at"]
+MANIFEST_FILE = "manifest.json"
+
+def get_parquet_schema():
+    """
+    Returns the fixed parquet schema of manifest records, so chunks with only NULLs in a column still match
+    """
+    fields = [(name, pyarrow.int64()) for name in INTEGER_COLUMNS] + [(name, pyarrow.string()) for name in STRING_COLUMNS]
+    fields += [(f"tag_list_{category}", pyarrow.list_(pyarrow.string())) for category in TAG_CATEGORIES]
+    return pyarrow.schema(fields)
+
+def get_shard_bounds(db_file: str, shard_size=100000, batch_size=1000000):
+    """
+    Returns [(first id, last id)] of consecutive shards of shard_size posts, streaming the ids once
+    """
+    db_dict = load_db(db_file, read_only=True, verbose=False)
+    db, Post = db_dict["db"], db_dict["Post"]
+    bounds = []
+    with db.connection_context():
+        cursor = db.execute_sql(f'SELECT "id" FROM "{Post._meta.table_name}" ORDER BY "id"')
+        count, first_id, last_id = 0, None, None
+        while rows := cursor.fetchmany(batch_size):
+            for post_id, in rows:
+                if first_id is None:
+                    first_id = post_id
+                last_id = post_id
+                count += 1
+                if count == shard_size:
+                    bounds.append((first_id, last_id))
+                    count, first_id = 0, None
+        if first_id is not None:
+            bounds.append((first_id, last_id))
+    db.close_all()
+    return bounds
+
+def post_record(post):
+    """
+    Returns the manifest record of a post whose tags were prefetched
+    """
+    record = {
+        "id": post.id,
+        "md5": post.md5,
+        "file_url": get_post_url(post),
+        "file_ext": post.file_ext,
+        "rating": post.rating,
+        "score": post.score,
+        "fav_count": post.fav_count,
+        "image_width": post.image_width,
+        "image_height": post.image_height,
+        "created_at": post.created_at,
+    }
+    for category in TAG_CATEGORIES:
+        record[f"tag_list_{category}"] = [tag.name for tag in post.tags_of_type(category)]
+    return record
+
+def _export_shard(args):
+    """
+    Writes one shard, run in a worker process. Returns (shard index, posts written).
+    """
+    db_file, output_dir, shard, first_id, last_id, chunk_size, output_format, ratings, min_score, tag_storage = args
+    extension = "parquet" if output_format == "parquet" else "jsonl"
+    path = os.path.join(output_dir, f"manifest-{shard:05d}.{extension}")
+    if os.path.exists(path):
+        return shard, None
+    db_dict = load_db(db_file, read_only=True, pool_size=1, tag_storage=tag_storage, verbose=False)
+    db, Post, prefetch_tags = db_dict["db"], db_dict["Post"], db_dict["prefetch_tags"]
+    written = 0
+    writer = None
+    temp_path = path + ".tmp"
+    with db.connection_context(), open(temp_path, "wb") as f:
+        last_seen = first_id - 1
+        while True:
+            # keyset pagination, one post query and one tag query per chunk
+            query = Post.select().where((Post.id > last_seen) & (Post.id <= last_id))
+            if ratings is not None:
+                query = query.where(Post.rating.in_([Post.rating.enum_map[rating] for rating in ratings]))
+            if min_score is not None:
+                query = query.where(Post.score >= min_score)
+            posts = prefetch_tags(query.order_by(Post.id).limit(chunk_size))
+            if not posts:
+                break
+            last_seen = posts[-1].id
+            records = [post_record(post) for post in posts]
+            if output_format == "parquet":
+                table = pyarrow.Table.from_pylist(records, schema=get_parquet_schema())
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(f, table.schema)
+                writer.write_table(table)
+            else:
+                f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8"))
+            written += len(records)
+        if output_format == "parquet":
+            if writer is None:
+                # no post of the shard matches the filters, an empty file would not be valid parquet
+                writer = pyarrow.parquet.ParquetWriter(f, get_parquet_schema())
+            writer.close()
+    db.close_all()
+    os.replace(temp_path, path)
+    return shard, written
+
+def remove_export(output_dir: str):
+    """
+    Deletes the shards, unfinished shards and manifest.json of a previous export in output_dir
+    """
+    for name in os.listdir(output_dir):
+        if name == MANIFEST_FILE or (name.startswith("manifest-") and name.endswith((".jsonl", ".parquet", ".tmp"))):
+            os.remove(os.path.join(output_dir, name))
+
+def export_manifest(db_file: str, output_dir: str, shard_size=100000, chunk_size=5000, workers=4, output_format="jsonl",
+                    ratings=None, min_score=None, tag_storage="relation", restart=False):
+    """
+    Exports the posts of db_file in id order to output_dir with workers processes, one shard per task.
+    ratings and min_score filter the posts. output_format="parquet" requires pyarrow.
+    A previous export in output_dir is resumed only if its manifest.json has the same shard bounds and settings,
+    otherwise ValueError is raised. restart=True deletes the previous export first.
+    Returns the number of posts written in this run.
+    """
+    if output_format == "parquet" and pyarrow is None:
+        raise ImportError("pyarrow is required for output_format='parquet'")
+    os.makedirs(output_dir, exist_ok=True)
+    start_time = time.time()
+    ratings = list(ratings) if ratings is not None else None
+    bounds = get_shard_bounds(db_file, shard_size)
+    manifest = {"database": os.path.abspath(db_file), "shard_size": shard_size, "format": output_format, "ratings": ratings,
+                "min_score": min_score, "tag_storage": tag_storage, "shards": [list(bound) for bound in bounds]}
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    if restart:
+        remove_export(output_dir)
+    elif os.path.exists(manifest_path):
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+        changed = [key for key in manifest if previous.get(key) != manifest[key]]
+        if changed:
+            # the shard files on disk cover other ids or other posts, skipping them by index would mix both exports
+            raise ValueError(f"{output_dir} holds an export with different {changed}, pass restart=True to export again")
+    elif any(name.startswith("manifest-") for name in os.listdir(output_dir)):
+        raise ValueError(f"{output_dir} holds shards without {MANIFEST_FILE}, pass restart=True to export again")
+    # written before the shards, so an interrupted run can be checked on resume
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump({**manifest, "exported_at": None}, f)
+    tasks = [(db_file, output_dir, shard, first_id, last_id, chunk_size, output_format, ratings, min_score, tag_storage)
+             for shard, (first_id, last_id) in enumerate(bounds)]
+    total = 0
+    skipped = 0
+    with multiprocessing.Pool(workers) as pool:
+        for shard, written in tqdm(pool.imap_unordered(_export_shard, tasks), total=len(tasks), desc="Exporting shards"):
+            if written is None:
+                skipped += 1
+            else:
+                total += written
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump({**manifest, "exported_at": time.time()}, f)
+    elapsed = time.time() - start_time
+    print(f"Exported {total} posts into {len(tasks) - skipped} shards ({skipped} already done) in {elapsed:.1f}s, {total / max(elapsed, 1e-9):.0f} posts/s")
+    return total
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export posts to sharded training manifests")
+    parser.add_argument("db_file")
+    parser.add_argument("output_dir")
+    parser.add_argument("--shard-size", type=int, default=100000)
+    parser.add_argument("--chunk-size", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    parser.add_argument("--ratings", nargs="*", default=None)
+    parser.add_argument("--min-score", type=int, default=None)
+    parser.add_argument("--tag-storage", choices=["relation", "blob"], default="relation")
+    parser.add_argument("--restart", action="store_true", help="delete a previous export in output_dir first")
+    args = parser.parse_args(sys.argv[1:])
+    export_manifest(args.db_file, args.output_dir, args.shard_size, args.chunk_size, args.workers, args.format,
+                    args.ratings, args.min_score, args.tag_storage, args.restart)
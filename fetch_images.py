@@ -0,0 +1,161 @@
+"""
+Downloads the original files of the posts of a Post select through ProxyHandler and records them in LocalPost.
+Files are stored as {folder}/{md5[:2]}/{md5[2:4]}/{md5}.{ext}, posts that already have a LocalPost.filepath are skipped,
+so an interrupted run is restarted by running it again.
+Usage:
+    db_dict = load_db("gelbooru2024-02.db")
+    Post = db_dict["Post"]
+    fetch_posts(db_dict, Post.select().where(Post.score > 100), ProxyHandler("proxies.txt"), "images")
+"""
+import os
+import time
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tqdm import tqdm
+from db import load_db
+from utils.proxyhandler import ProxyHandler
+from utils.downloader import RangedDownloader, get_post_url, file_md5
+
+class HostRateLimiter:
+    """
+    Allows at most rate requests per second to each host
+    """
+    def __init__(self, rate=10):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = {}
+        self.lock = threading.Lock()
+    def wait(self, url):
+        """
+        Blocks until a request to the host of url is allowed
+        """
+        host = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            now = time.time()
+            scheduled = max(self.next_time.get(host, 0), now)
+            self.next_time[host] = scheduled + self.interval
+        if scheduled > now:
+            time.sleep(scheduled - now)
+
+def get_sharded_path(folder, md5, ext):
+    """
+    Returns the path of a file in the sharded layout
+    """
+    return os.path.join(folder, md5[:2], md5[2:4], f"{md5}.{ext}")
+
+def iterate_pending_posts(db_dict: dict, query, batch_size=1000):
+    """
+    Yields the posts of query in id order that have no LocalPost.filepath yet, paging by id instead of OFFSET
+    """
+    Post, LocalPost = db_dict["Post"], db_dict["LocalPost"]
+    downloaded = LocalPost.select(LocalPost.post).where(LocalPost.filepath.is_null(False))
+    last_id = -1
+    while True:
+        batch = list(query.where((Post.id > last_id) & (Post.id.not_in(downloaded))).order_by(Post.id).limit(batch_size))
+        if not batch:
+            return
+        yield from batch
+        last_id = batch[-1].id
+
+def fetch_post(post, handler:ProxyHandler, folder, limiter:HostRateLimiter, downloader:RangedDownloader=None, ranged_threshold=16 * 1024 * 1024):
+    """
+    Downloads the original file of a post, returns (path, bytes downloaded) or (None, 0) on failure.
+    Files larger than ranged_threshold (when the size is known) use the ranged downloader.
+    """
+    url = get_post_url(post)
+    if not url or not post.md5:
+        return None, 0
+    ext = post.file_ext or url.rsplit('.', 1)[-1]
+    path = get_sharded_path(folder, post.md5, ext)
+    if os.path.exists(path):
+        if file_md5(path) == post.md5:
+            return path, 0
+        # a corrupt file would fail every rerun, download it again
+        print(f"Error: md5 mismatch for the existing file of post {post.id}, downloading it again")
+        os.remove(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    limiter.wait(url)
+    if downloader is not None and post.file_size and post.file_size > ranged_threshold:
+        if downloader.download(url, path, md5=post.md5, size=post.file_size):
+            return path, post.file_size
+        return None, 0
+    response = handler.get(url)
+    if response is None:
+        return None, 0
+    with open(path + ".part", 'wb') as f:
+        f.write(response.content)
+    if file_md5(path + ".part") != post.md5:
+        print(f"Error: md5 mismatch for post {post.id}")
+        os.remove(path + ".part")
+        return None, 0
+    os.replace(path + ".part", path)
+    return path, len(response.content)
+
+def fetch_posts(db_dict: dict, query, handler:ProxyHandler, folder, max_workers=16, host_rate=10, commit_every=500, batch_size=1000):
+    """
+    Downloads the posts of query with max_workers concurrent downloads and at most host_rate requests per second per host.
+    LocalPost rows are inserted in batches of commit_every from the calling thread.
+    Returns (downloaded posts, failed posts, downloaded bytes).
+    """
+    db, LocalPost = db_dict["db"], db_dict["LocalPost"]
+    limiter = HostRateLimiter(host_rate)
+    downloader = RangedDownloader(handler)
+    pending_rows = []
+    downloaded, failed, total_bytes = 0, 0, 0
+    start_time = time.time()
+    pbar = tqdm(desc="Fetching images", unit="post")
+    def flush():
+        if not pending_rows:
+            return
+        post_ids = [row[0] for row in pending_rows]
+        with db.atomic():
+            # rows without filepath (e.g. with only latentpath) are completed instead of duplicated
+            for post_id, filepath in pending_rows:
+                LocalPost.update(filepath=filepath).where((LocalPost.post == post_id) & LocalPost.filepath.is_null()).execute()
+            existing = {row[0] for row in LocalPost.select(LocalPost.post).where(LocalPost.post.in_(post_ids)).tuples()}
+            rows = [row for row in pending_rows if row[0] not in existing]
+            if rows:
+                LocalPost.insert_many(rows, fields=[LocalPost.post, LocalPost.filepath]).execute()
+        pending_rows.clear()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        posts = iterate_pending_posts(db_dict, query, batch_size)
+        try:
+            while True:
+                # keep the queue bounded so posts are read from the database as downloads finish
+                for post in posts:
+                    futures[executor.submit(fetch_post, post, handler, folder, limiter, downloader)] = post.id
+                    if len(futures) >= max_workers * 2:
+                        break
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    post_id = futures.pop(future)
+                    path, size = future.result()
+                    if path is None:
+                        failed += 1
+                    else:
+                        downloaded += 1
+                        total_bytes += size
+                        pending_rows.append((post_id, path))
+                    pbar.update(1)
+                elapsed = time.time() - start_time
+                pbar.set_postfix(posts_per_sec=f"{downloaded / elapsed:.1f}", mb_per_sec=f"{total_bytes / elapsed / 1e6:.2f}", failed=failed)
+                if len(pending_rows) >= commit_every:
+                    flush()
+        finally:
+            flush()
+            pbar.close()
+    elapsed = time.time() - start_time
+    print(f"Downloaded {downloaded} posts ({total_bytes / 1e6:.1f} MB) in {elapsed:.1f}s, {downloaded / elapsed:.1f} posts/s, "
+          f"{total_bytes / elapsed / 1e6:.2f} MB/s, {failed} failed")
+    return downloaded, failed, total_bytes
+
+if __name__ == "__main__":
+    db_dict = load_db("gelbooru2024-02.db")
+    Post = db_dict["Post"]
+    handler = ProxyHandler("proxies.txt", wait_time=0.1)
+    handler.check()
+    query = Post.select().where((Post.score > 100) & (Post.rating == "general"))
+    fetch_posts(db_dict, query, handler, "images")
@@ -1,7 +1,11 @@
 from utils.gelboorutags import GelbooruTag as TagHandler
 from db import load_db
-from peewee import fn
+from collections import Counter
 from tqdm import tqdm
+import sys
+import time
+
+STAGING_TABLE = "tagtypefix" # resolved (tag id, type) rows, kept until applied so runs can resume
 handler = TagHandler(exception_handle=0) #general for 0
 
 def fix_tags(tags):
@@ -10,37 +14,72 @@ def fix_tags(tags):
         return "general"
     return result
 
-# test
-
-db_dict = load_db('gelbooru2024-02.db')
-GelbooruDB, GelbooruPost, GelbooruTag, GelbooruPostTagRelation = db_dict['db'], db_dict['Post'], db_dict['Tag'], db_dict['PostTagRelation']
+def resolve_type(handler: TagHandler, tag_name: str):
+    """
+    Returns the type name of a tag from the in-memory dictionary only, or None if it cannot be resolved.
+    deprecated tags are treated as general, missing tags use handler.exception_handle.
+    """
+    tag = handler.get_tag(tag_name)
+    type_id = tag["type"] if tag is not None else handler.exception_handle
+    if type_id is None:
+        return None
+    type_name = TagHandler.TAG_TYPE.get(type_id)
+    if type_name == "deprecated":
+        return "general"
+    return type_name
 
-# get tags which is not unknown type
-tags = GelbooruTag.select().where(GelbooruTag.type != "unknown")
-print(tags.count())
-# get random post
-tags = GelbooruTag.select().where(GelbooruTag.type == "unknown")
-pbar = tqdm(tags, total=tags.count()) # Tag -> fix_tags(tag.name) -> [Tag.type]
-fixed_count = 0
-# batch update
-batch_size = 1000
-batch = []
-for tag in tags:
-    batch.append((fix_tags(tag.name), tag.id))
-    if len(batch) >= batch_size:
-        with GelbooruDB.atomic():
-            pbar.set_description("Updating")
-            for fixed_tag, tag_id in batch:
-                GelbooruTag.update(type=fixed_tag).where(GelbooruTag.id == tag_id).execute()
-        fixed_count += len(batch)
-        batch = []
-        pbar.update(batch_size)
-        pbar.set_postfix(fixed=fixed_count)
+def reclassify_unknown_tags(db_dict: dict, handler: TagHandler, dry_run=False, batch_size=100000):
+    """
+    Reclassifies every 'unknown' tag with one pass over the tag dictionary and one UPDATE ... FROM join.
+    Resolved types are staged in STAGING_TABLE in committed batches, so an interrupted run resumes where it stopped.
+    dry_run=True counts the types in memory and prints them, the database is left unchanged.
+    Returns the counts per type.
+    """
+    db, Tag = db_dict["db"], db_dict["Tag"]
+    tag_table = Tag._meta.table_name
+    unknown = Tag.type.enum_map["unknown"]
+    start_time = time.time()
+    if not dry_run:
+        db.execute_sql(f'CREATE TABLE IF NOT EXISTS "{STAGING_TABLE}" ("id" INTEGER NOT NULL PRIMARY KEY, "type" INTEGER NOT NULL)')
+    staging_exists = db.table_exists(STAGING_TABLE)
+    if staging_exists:
+        cursor = db.execute_sql(f'SELECT "t"."id", "t"."name" FROM "{tag_table}" AS "t" LEFT JOIN "{STAGING_TABLE}" AS "f" ON "f"."id" = "t"."id" '
+                                f'WHERE "t"."type" = ? AND "f"."id" IS NULL', (unknown,))
     else:
-        pbar.set_description("Collecting")
-if batch:
-    with GelbooruDB.atomic():
-        for fixed_tag, tag_id in batch:
-            GelbooruTag.update(type=fixed_tag).where(GelbooruTag.id == tag_id).execute()
-    fixed_count += len(batch)
-    pbar.set_postfix(fixed=fixed_count)
+        cursor = db.execute_sql(f'SELECT "id", "name" FROM "{tag_table}" WHERE "type" = ?', (unknown,))
+    unresolved = 0
+    counts = Counter() # dry run counts of the tags not staged yet
+    pbar = tqdm(desc="Resolving unknown tags")
+    while rows := cursor.fetchmany(batch_size):
+        staged = []
+        for tag_id, tag_name in rows:
+            type_name = resolve_type(handler, tag_name)
+            if type_name is None:
+                unresolved += 1
+                continue
+            staged.append((tag_id, Tag.type.enum_map[type_name]))
+            if dry_run:
+                counts[type_name] += 1
+        if not dry_run:
+            with db.atomic():
+                db.cursor().executemany(f'INSERT OR REPLACE INTO "{STAGING_TABLE}" ("id", "type") VALUES (?, ?)', staged)
+        pbar.update(len(rows))
+    pbar.close()
+    if staging_exists:
+        for type_code, count in db.execute_sql(f'SELECT "f"."type", COUNT(*) FROM "{STAGING_TABLE}" AS "f" JOIN "{tag_table}" AS "t" ON "t"."id" = "f"."id" '
+                                               f'WHERE "t"."type" = ? GROUP BY "f"."type"', (unknown,)):
+            counts[Tag.type.enum_list[type_code]] += count
+    print(f"Unknown tags to reclassify: {dict(counts)}, unresolved in this pass: {unresolved}")
+    if dry_run:
+        return counts
+    with db.atomic():
+        cursor = db.execute_sql(f'UPDATE "{tag_table}" SET "type" = "f"."type" FROM "{STAGING_TABLE}" AS "f" '
+                                f'WHERE "{tag_table}"."id" = "f"."id" AND "{tag_table}"."type" = ?', (unknown,))
+        print(f"Updated {cursor.rowcount} tags in {time.time() - start_time:.1f}s")
+        db.execute_sql(f'DROP TABLE "{STAGING_TABLE}"')
+    return counts
+
+if __name__ == "__main__":
+    db_dict = load_db('gelbooru2024-02.db')
+    # python fix_tags.py --dry-run prints the counts per type only
+    reclassify_unknown_tags(db_dict, handler, dry_run="--dry-run" in sys.argv)
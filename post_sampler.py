@@ -0,0 +1,191 @@
+"""
+Random post sampling without ORDER BY RANDOM(), which sorts the whole post table on every call.
+Usage:
+    sampler = PostSampler(db_dict)
+    posts = sampler.sample(16)
+    sampler = PostSampler(db_dict, include=["1girl"], ratings=["general"], weight="score")
+    post_ids = sampler.sample_ids(1000)
+"""
+import time
+import threading
+import numpy as np
+from peewee import fn
+
+WEIGHT_COLUMNS = ["score", "fav_count"]
+MIN_ACCEPT_RATE = 0.1 # below this hit rate over all probes of a draw, id probing switches to the materialized ids
+MIN_PROBES = 64 # ids probed per round at least, so a few unlucky misses do not trigger the full scan
+
+def build_alias_table(weights):
+    """
+    Returns (prob, alias) of Vose's alias method for non-negative weights, a draw is O(1)
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    n = len(weights)
+    scaled = weights * (n / weights.sum())
+    prob = np.ones(n, dtype=np.float64)
+    alias = np.arange(n, dtype=np.int64)
+    small = list(np.flatnonzero(scaled < 1.0))
+    large = list(np.flatnonzero(scaled >= 1.0))
+    while small and large:
+        less, more = small.pop(), large.pop()
+        prob[less] = scaled[less]
+        alias[less] = more
+        scaled[more] -= 1.0 - scaled[less]
+        if scaled[more] < 1.0:
+            small.append(more)
+        else:
+            large.append(more)
+    return prob, alias
+
+def alias_draw(prob, alias, k, rng):
+    """
+    Returns k indices drawn from an alias table
+    """
+    slots = rng.integers(0, len(prob), size=k)
+    return np.where(rng.random(k) < prob[slots], slots, alias[slots])
+
+class PostSampler:
+    """
+    Draws uniform or weighted random posts, optionally restricted to posts having all include tags,
+    none of the exclude tags and one of the ratings.
+    Unfiltered uniform draws probe random ids between MIN(id) and MAX(id), one IN query per round.
+    Filtered or weighted samplers materialize the candidate ids (and weights) once,
+    weighted draws then use an alias table. tag_index (a tag_index.TagIndex) resolves tag filters when given.
+    weight is a Post column in WEIGHT_COLUMNS, posts with a weight of 0 or less are skipped (uniform if all are).
+    """
+    def __init__(self, db_dict: dict, include=(), exclude=(), ratings=None, weight=None, tag_index=None, seed=None):
+        if weight is not None and weight not in WEIGHT_COLUMNS:
+            raise ValueError(f"Unknown weight {weight}, must be one of {WEIGHT_COLUMNS}")
+        self.db_dict = db_dict
+        self.include, self.exclude = list(include), list(exclude)
+        self.ratings = ratings
+        self.weight = weight
+        self.tag_index = tag_index
+        self.rng = np.random.default_rng(seed)
+        self.ids = None
+        self.alias_table = None
+        self.id_range = None
+        self.lock = threading.Lock() # the generator and the lazy materialization are shared by threads
+
+    @property
+    def filtered(self):
+        return bool(self.include or self.exclude) or self.ratings is not None
+
+    def _rating_codes(self):
+        rating_field = self.db_dict["Post"].rating
+        return [rating_field.enum_map[rating] if isinstance(rating, str) else rating for rating in self.ratings]
+
+    def _tag_filtered_ids(self):
+        """
+        Returns the sorted ids of posts matching the tag filters
+        """
+        if self.tag_index is not None:
+            return self.tag_index.query(include=self.include, exclude=self.exclude)
+        Post, Tag, PostTagRelation = self.db_dict["Post"], self.db_dict["Tag"], self.db_dict["PostTagRelation"]
+        query = Post.select(Post.id)
+        if self.include:
+            include_ids = [tag_id for tag_id, in Tag.select(Tag.id).where(Tag.name.in_(self.include)).tuples()]
+            if len(include_ids) != len(set(self.include)):
+                return np.zeros(0, dtype=np.int64) # an include tag does not exist
+            matching = (PostTagRelation.select(PostTagRelation.post).where(PostTagRelation.tag.in_(include_ids))
+                        .group_by(PostTagRelation.post).having(fn.COUNT(PostTagRelation.tag) == len(include_ids)))
+            query = query.where(Post.id.in_(matching))
+        if self.exclude:
+            query = query.where(Post.id.not_in(PostTagRelation.select(PostTagRelation.post).join(Tag).where(Tag.name.in_(self.exclude))))
+        return np.array([post_id for post_id, in query.order_by(Post.id).tuples()], dtype=np.int64)
+
+    def materialize(self):
+        """
+        Loads the candidate ids (and the alias table of their weights), done on the first draw that needs them
+        """
+        start_time = time.time()
+        Post = self.db_dict["Post"]
+        columns = [Post.id] + ([getattr(Post, self.weight)] if self.weight else [])
+        query = Post.select(*columns).order_by(Post.id)
+        if self.ratings is not None:
+            query = query.where(Post.rating.in_(self._rating_codes()))
+        rows = np.array(list(query.tuples()), dtype=np.int64).reshape(-1, len(columns))
+        ids = rows[:, 0]
+        weights = rows[:, 1] if self.weight else None
+        if self.include or self.exclude:
+            mask = np.isin(ids, self._tag_filtered_ids(), assume_unique=True)
+            ids = ids[mask]
+            weights = weights[mask] if weights is not None else None
+        if weights is not None and (weights > 0).any():
+            # posts with a weight of 0 or less are never drawn
+            positive = weights > 0
+            ids = ids[positive]
+            self.alias_table = build_alias_table(weights[positive])
+        self.ids = ids
+        print(f"Sampler materialized {len(ids)} candidate posts in {time.time() - start_time:.2f}s")
+
+    def _probe_ids(self, k, unique):
+        """
+        Draws ids by probing random ids in the id range, returns None if the ids are too sparse or k cannot be filled.
+        Each round probes at least MIN_PROBES ids, sparseness is judged on the hit rate of every probe so far.
+        """
+        Post = self.db_dict["Post"]
+        if self.id_range is None:
+            self.id_range = Post.select(fn.MIN(Post.id), fn.MAX(Post.id)).tuples().get()
+        min_id, max_id = self.id_range
+        if min_id is None:
+            return []
+        sampled = []
+        seen = set()
+        probes, hits = 0, 0
+        for _ in range(32):
+            if len(sampled) >= k:
+                return sampled[:k]
+            wanted = k - len(sampled)
+            candidates = self.rng.integers(min_id, max_id + 1, size=max(2 * wanted, MIN_PROBES)).tolist()
+            probed = list(set(candidates))
+            existing = {post_id for post_id, in Post.select(Post.id).where(Post.id.in_(probed)).tuples()}
+            probes += len(probed)
+            hits += len(existing)
+            if hits < MIN_ACCEPT_RATE * probes:
+                return None
+            for post_id in candidates:
+                if post_id in existing and not (unique and post_id in seen):
+                    sampled.append(post_id)
+                    seen.add(post_id)
+        return sampled[:k] if len(sampled) >= k else None # k is close to the number of posts
+
+    def sample_ids(self, k=1, unique=True):
+        """
+        Returns k random post ids, fewer if there are fewer candidates (unique=True draws without replacement)
+        """
+        with self.lock:
+            return self._sample_ids(k, unique)
+
+    def _sample_ids(self, k, unique):
+        if self.ids is None and not self.filtered and self.weight is None:
+            sampled = self._probe_ids(k, unique)
+            if sampled is not None:
+                return sampled
+        if self.ids is None:
+            self.materialize()
+        n = len(self.ids)
+        if n == 0:
+            return []
+        if self.alias_table is None:
+            return self.ids[self.rng.choice(n, size=min(k, n) if unique else k, replace=not unique)].tolist()
+        prob, alias = self.alias_table
+        if not unique:
+            return self.ids[alias_draw(prob, alias, k, self.rng)].tolist()
+        k = min(k, n)
+        sampled = {}
+        for _ in range(32):
+            for index in alias_draw(prob, alias, 2 * (k - len(sampled)), self.rng).tolist():
+                sampled.setdefault(index, None)
+            if len(sampled) >= k:
+                break
+        return self.ids[list(sampled)[:k]].tolist()
+
+    def sample(self, k=1, unique=True):
+        """
+        Returns k random posts in draw order, loaded with one query
+        """
+        Post = self.db_dict["Post"]
+        post_ids = self.sample_ids(k, unique)
+        posts = {post.id: post for post in Post.select().where(Post.id.in_(list(set(post_ids))))}
+        return [posts[post_id] for post_id in post_ids if post_id in posts]
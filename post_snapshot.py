@@ -0,0 +1,137 @@
+"""
+Read-only columnar snapshot of Post metadata, one fixed-width .npy file per column.
+String columns are stored as uint32 codes into a dictionary of utf-8 strings.
+Usage:
+    export_snapshot(db_dict)
+    snapshot = PostSnapshot("gelbooru2024-02.db.snapshot")
+    ids = snapshot["id"][(snapshot["score"] > 100) & (snapshot["rating"] == snapshot.rating_code("general"))]
+"""
+import os
+import json
+import time
+import numpy as np
+from numpy.lib.format import open_memmap
+from tqdm import tqdm
+from db import parse_created_at
+
+# column -> dtype, NULL values are stored as 0 (created_at as -1, rating as 255)
+NUMERIC_COLUMNS = {
+    "id": "<i8",
+    "score": "<i4",
+    "rating": "u1",
+    "image_width": "<i4",
+    "image_height": "<i4",
+    "fav_count": "<i4",
+    "created_at": "<i8", # epoch seconds
+}
+STRING_COLUMNS = ["file_ext", "source"]
+NULL_RATING = 255
+NULL_CREATED_AT = -1
+
+def get_snapshot_path(db_file: str):
+    """
+    Returns the snapshot directory of a database file
+    """
+    return db_file + ".snapshot"
+
+def export_snapshot(db_dict: dict, path: str = None, batch_size=100000):
+    """
+    Exports the Post columns in id order into path (default: next to the database file).
+    """
+    db, Post = db_dict["db"], db_dict["Post"]
+    path = path or get_snapshot_path(db.database)
+    os.makedirs(path, exist_ok=True)
+    start_time = time.time()
+    count = Post.select().count()
+    columns = {name: open_memmap(os.path.join(path, f"{name}.npy"), mode="w+", dtype=dtype, shape=(count,)) for name, dtype in NUMERIC_COLUMNS.items()}
+    for name in STRING_COLUMNS:
+        columns[name] = open_memmap(os.path.join(path, f"{name}.npy"), mode="w+", dtype="<u4", shape=(count,))
+    dictionaries = {name: {} for name in STRING_COLUMNS}
+    selected = ", ".join(f'"{name}"' for name in list(NUMERIC_COLUMNS) + STRING_COLUMNS)
+    cursor = db.execute_sql(f'SELECT {selected} FROM "{Post._meta.table_name}" ORDER BY "id"')
+    position = 0
+    pbar = tqdm(total=count, desc="Exporting snapshot")
+    while rows := cursor.fetchmany(batch_size):
+        rows = list(zip(*rows))
+        end = position + len(rows[0])
+        for index, name in enumerate(NUMERIC_COLUMNS):
+            values = rows[index]
+            if name == "created_at":
+                values = [parse_created_at(value) for value in values]
+                values = [NULL_CREATED_AT if value is None else value for value in values]
+            elif name == "rating":
+                values = [NULL_RATING if value is None else value for value in values]
+            else:
+                values = [0 if value is None else value for value in values]
+            columns[name][position:end] = values
+        for index, name in enumerate(STRING_COLUMNS, start=len(NUMERIC_COLUMNS)):
+            dictionary = dictionaries[name]
+            columns[name][position:end] = [dictionary.setdefault(value or "", len(dictionary)) for value in rows[index]]
+        position = end
+        pbar.update(len(rows[0]))
+    pbar.close()
+    for column in columns.values():
+        column.flush()
+    for name, dictionary in dictionaries.items():
+        encoded = [value.encode("utf-8") for value in dictionary]
+        offsets = np.zeros(len(encoded) + 1, dtype="<i8")
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        np.save(os.path.join(path, f"{name}.offsets.npy"), offsets)
+        with open(os.path.join(path, f"{name}.strings.bin"), "wb") as f:
+            f.write(b"".join(encoded))
+    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"rows": position, "rating": Post.rating.enum_list, "exported_at": time.time()}, f)
+    print(f"Exported {position} posts to {path} in {time.time() - start_time:.1f}s")
+    return PostSnapshot(path)
+
+class PostSnapshot:
+    """
+    Zero-copy reader of a snapshot, columns are memory-mapped numpy arrays.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.columns = {}
+        for name in list(NUMERIC_COLUMNS) + STRING_COLUMNS:
+            self.columns[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        self._dictionaries = {}
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def rating_code(self, rating: str):
+        """
+        Returns the stored code of a rating name
+        """
+        return self.meta["rating"].index(rating)
+
+    def strings(self, name: str):
+        """
+        Returns the dictionary of a string column as a list, codes index into it
+        """
+        if name not in self._dictionaries:
+            offsets = np.load(os.path.join(self.path, f"{name}.offsets.npy"))
+            with open(os.path.join(self.path, f"{name}.strings.bin"), "rb") as f:
+                data = f.read()
+            self._dictionaries[name] = [data[start:end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+        return self._dictionaries[name]
+
+    def string_code(self, name: str, value: str):
+        """
+        Returns the code of value in a string column, or -1 if it never occurs
+        """
+        try:
+            return self.strings(name).index(value)
+        except ValueError:
+            return -1
+
+    def decode(self, name: str, codes):
+        """
+        Decodes string column codes into strings
+        """
+        strings = self.strings(name)
+        return [strings[code] for code in np.asarray(codes).tolist()]
@@ -0,0 +1,203 @@
+"""
+Inverted tag index for boolean tag queries, stored next to the database file.
+Each tag keeps its posts as a sorted uint32 array, or as a bitmap over post ids when that is smaller.
+"""
+import os
+import json
+import time
+import numpy as np
+from peewee import fn
+from tqdm import tqdm
+
+ARRAY_CONTAINER = 0
+BITMAP_CONTAINER = 1
+NO_POST = 255 # ratings value for ids without a post
+
+def get_index_path(db_file: str):
+    """
+    Returns the index directory of a database file
+    """
+    return db_file + ".tagindex"
+
+def _bitmap_to_ids(words):
+    return np.flatnonzero(np.unpackbits(words.view(np.uint8), bitorder="little"))
+
+def _in_bitmap(words, ids):
+    """
+    Returns a boolean mask of ids that are set in the bitmap
+    """
+    word_index = ids >> 5
+    mask = np.zeros(len(ids), dtype=bool)
+    inside = word_index < len(words)
+    mask[inside] = (words[word_index[inside]] >> (ids[inside] & 31).astype(np.uint32)) & 1 == 1
+    return mask
+
+class TagIndex:
+    """
+    Memory-mapped inverted index over PostTagRelation.
+    Usage:
+        TagIndex.build(db_dict) # once, and again after ingestion
+        index = TagIndex(db_dict)
+        post_ids = index.query(include=["1girl", "solo"], exclude=["monochrome"], ratings=["general"])
+    """
+    def __init__(self, db_dict: dict, path: str = None):
+        self.db_dict = db_dict
+        self.path = path or get_index_path(db_dict["db"].database)
+        self.load()
+
+    def load(self):
+        """
+        Memory-maps the index files
+        """
+        if not os.path.exists(os.path.join(self.path, "meta.json")):
+            raise FileNotFoundError(f"Tag index not found at {self.path}, build it with TagIndex.build")
+        with open(os.path.join(self.path, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.tag_ids = np.load(os.path.join(self.path, "tag_ids.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(self.path, "offsets.npy"), mmap_mode="r")
+        self.kinds = np.load(os.path.join(self.path, "kinds.npy"), mmap_mode="r")
+        self.ratings = np.load(os.path.join(self.path, "ratings.npy"), mmap_mode="r")
+        self.postings = np.memmap(os.path.join(self.path, "postings.bin"), dtype="<u4", mode="r") \
+            if self.offsets[-1] > 0 else np.zeros(0, dtype="<u4")
+
+    @staticmethod
+    def build(db_dict: dict, path: str = None, batch_size=1000000):
+        """
+        Builds the index from PostTagRelation, streaming the relations in tag id order.
+        """
+        db, Post, PostTagRelation = db_dict["db"], db_dict["Post"], db_dict["PostTagRelation"]
+        path = path or get_index_path(db.database)
+        os.makedirs(path, exist_ok=True)
+        start_time = time.time()
+        max_post_id = Post.select(fn.MAX(Post.id)).scalar() or 0
+        n_words = max_post_id // 32 + 1
+        ratings = np.full(max_post_id + 1, NO_POST, dtype=np.uint8)
+        cursor = db.execute_sql(f'SELECT "id", "rating" FROM "{Post._meta.table_name}"')
+        while rows := cursor.fetchmany(batch_size):
+            rows = np.array(rows, dtype=np.int64)
+            ratings[rows[:, 0]] = rows[:, 1]
+        tag_ids, offsets, kinds = [], [0], []
+        relation_count = PostTagRelation.select().count()
+        pbar = tqdm(total=relation_count, desc="Building tag index")
+        with open(os.path.join(path, "postings.bin"), "wb") as postings:
+            def write_tag(tag_id, post_ids):
+                post_ids = np.unique(post_ids).astype("<u4")
+                if len(post_ids) > n_words:
+                    bits = np.zeros(n_words * 32, dtype=bool)
+                    bits[post_ids] = True
+                    data = np.packbits(bits, bitorder="little").view("<u4")
+                    kinds.append(BITMAP_CONTAINER)
+                else:
+                    data = post_ids
+                    kinds.append(ARRAY_CONTAINER)
+                postings.write(data.tobytes())
+                tag_ids.append(tag_id)
+                offsets.append(offsets[-1] + len(data))
+            cursor = db.execute_sql(f'SELECT "tag_id", "post_id" FROM "{PostTagRelation._meta.table_name}" ORDER BY "tag_id"')
+            carry = np.zeros((0, 2), dtype=np.int64)
+            while rows := cursor.fetchmany(batch_size):
+                pbar.update(len(rows))
+                pairs = np.concatenate([carry, np.array(rows, dtype=np.int64)])
+                # the last tag may continue in the next batch
+                complete = pairs[:, 0] != pairs[-1, 0]
+                carry = pairs[~complete]
+                pairs = pairs[complete]
+                boundaries = np.flatnonzero(np.diff(pairs[:, 0])) + 1
+                for group in np.split(pairs, boundaries) if len(pairs) else []:
+                    write_tag(int(group[0, 0]), group[:, 1])
+            if len(carry):
+                write_tag(int(carry[0, 0]), carry[:, 1])
+        pbar.close()
+        np.save(os.path.join(path, "tag_ids.npy"), np.array(tag_ids, dtype=np.int64))
+        np.save(os.path.join(path, "offsets.npy"), np.array(offsets, dtype=np.int64))
+        np.save(os.path.join(path, "kinds.npy"), np.array(kinds, dtype=np.uint8))
+        np.save(os.path.join(path, "ratings.npy"), ratings)
+        with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"max_post_id": max_post_id, "tags": len(tag_ids), "relations": relation_count, "built_at": time.time()}, f)
+        print(f"Built tag index for {len(tag_ids)} tags in {time.time() - start_time:.1f}s at {path}")
+        return TagIndex(db_dict, path)
+
+    def resolve_tags(self, tag_names):
+        """
+        Returns tag name -> tag id for the names that exist
+        """
+        Tag = self.db_dict["Tag"]
+        return dict(Tag.select(Tag.name, Tag.id).where(Tag.name.in_(list(tag_names))).tuples())
+
+    def posting(self, tag_id: int):
+        """
+        Returns (container kind, data) of the tag, or None if the tag has no posts
+        """
+        slot = np.searchsorted(self.tag_ids, tag_id)
+        if slot >= len(self.tag_ids) or self.tag_ids[slot] != tag_id:
+            return None
+        return int(self.kinds[slot]), self.postings[self.offsets[slot]:self.offsets[slot + 1]]
+
+    def post_ids(self, tag_id: int):
+        """
+        Returns the sorted post ids of the tag
+        """
+        posting = self.posting(tag_id)
+        if posting is None:
+            return np.zeros(0, dtype=np.int64)
+        kind, data = posting
+        return _bitmap_to_ids(data) if kind == BITMAP_CONTAINER else data.astype(np.int64)
+
+    def query(self, include=(), exclude=(), ratings=None):
+        """
+        Returns the ids of posts having all include tags, none of the exclude tags and one of the ratings, in ascending order.
+        Tags can be given as names or ids.
+        """
+        include_ids = self._to_tag_ids(include, strict=True)
+        exclude_ids = self._to_tag_ids(exclude, strict=False)
+        if include_ids is None:
+            return np.zeros(0, dtype=np.int64) # an include tag does not exist
+        includes, excludes = [], []
+        for tag_id in include_ids:
+            posting = self.posting(tag_id)
+            if posting is None:
+                return np.zeros(0, dtype=np.int64)
+            includes.append(posting)
+        for tag_id in exclude_ids:
+            posting = self.posting(tag_id)
+            if posting is not None:
+                excludes.append(posting)
+        arrays = sorted((data for kind, data in includes if kind == ARRAY_CONTAINER), key=len)
+        bitmaps = [data for kind, data in includes if kind == BITMAP_CONTAINER]
+        if arrays:
+            result = np.asarray(arrays[0])
+            for data in arrays[1:]:
+                result = np.intersect1d(result, data, assume_unique=True)
+            for data in bitmaps:
+                result = result[_in_bitmap(data, result)]
+        elif bitmaps:
+            words = np.array(bitmaps[0])
+            for data in bitmaps[1:]:
+                words &= data
+            for data in [data for kind, data in excludes if kind == BITMAP_CONTAINER]:
+                words &= ~data
+            excludes = [(kind, data) for kind, data in excludes if kind != BITMAP_CONTAINER]
+            result = _bitmap_to_ids(words)
+        else:
+            result = np.flatnonzero(self.ratings != NO_POST)
+        for kind, data in excludes:
+            if kind == BITMAP_CONTAINER:
+                result = result[~_in_bitmap(data, result)]
+            else:
+                result = result[~np.isin(result, data, assume_unique=True)]
+        if ratings is not None:
+            rating_field = self.db_dict["Post"].rating
+            codes = [rating_field.enum_map[rating] if isinstance(rating, str) else rating for rating in ratings]
+            result = result[np.isin(self.ratings[result], codes)]
+        return result.astype(np.int64)
+
+    def _to_tag_ids(self, tags, strict=True):
+        """
+        Converts names to ids. Unknown names make it return None if strict, otherwise they are dropped.
+        """
+        tags = list(tags or [])
+        names = [tag for tag in tags if isinstance(tag, str)]
+        resolved = self.resolve_tags(names) if names else {}
+        if strict and len(resolved) != len(set(names)):
+            return None
+        return [resolved[tag] if isinstance(tag, str) else int(tag) for tag in tags if not isinstance(tag, str) or tag in resolved]
@@ -0,0 +1,151 @@
+"""
+Ranged Downloader Class
+"""
+import os
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .proxyhandler import ProxyHandler
+
+def get_post_url(post):
+    """
+    Returns the original file url of a post, large_file_url holds gelbooru's file_url
+    """
+    return post.large_file_url or post.file_url
+
+def file_md5(path, block_size=1 << 20):
+    """
+    Returns the md5 hex digest of a file
+    """
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+def record_local_post(LocalPost, post_id, filepath):
+    """
+    Sets LocalPost.filepath of the post, creating the row if needed
+    """
+    updated = LocalPost.update(filepath=filepath).where(LocalPost.post == post_id).execute()
+    if not updated:
+        LocalPost.create(post=post_id, filepath=filepath)
+
+class RangedDownloader:
+    """
+    Downloads a file as ranges of chunk_size bytes through ProxyHandler.get_filepart, max_workers ranges at a time.
+    Ranges are written at their offsets into a preallocated {path}.part file,
+    finished ranges are recorded in a {path}.part.json sidecar so an interrupted download resumes.
+    Usage:
+        downloader = RangedDownloader(handler)
+        downloader.download_post(post, db_dict["LocalPost"], "images")
+    """
+    def __init__(self, handler:ProxyHandler, chunk_size=4 * 1024 * 1024, max_workers=8, max_retry=5):
+        self.handler = handler
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.max_retry = max_retry
+    def _load_state(self, state_path, url, size):
+        """
+        Returns the sidecar state, or a new one if it is missing or belongs to another download
+        """
+        if os.path.exists(state_path):
+            try:
+                with open(state_path, 'r', encoding='utf-8') as f:
+                    state = json.load(f)
+                if state["url"] == url and state["size"] == size and state["chunk_size"] == self.chunk_size:
+                    return state
+            except Exception as exce:
+                if isinstance(exce, KeyboardInterrupt):
+                    raise exce
+        return {"url": url, "size": size, "chunk_size": self.chunk_size, "done": []}
+    def _save_state(self, state_path, state):
+        """
+        Writes the sidecar atomically
+        """
+        with open(state_path + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(state_path + ".tmp", state_path)
+    def _fetch_range(self, url, start, end):
+        """
+        Returns the bytes of [start, end], end is inclusive, or None if every try failed
+        """
+        for _ in range(self.max_retry):
+            response = self.handler.get_filepart(url, start, end)
+            if response is None:
+                continue
+            if len(response.content) != end - start + 1:
+                print(f"Error: got {len(response.content)} bytes for range {start}-{end} of {url}")
+                continue
+            return response.content
+        return None
+    def download(self, url, path, md5=None, size=None):
+        """
+        Downloads url to path, returns True if the file is complete (and matches md5 if given).
+        An existing file at path that does not match md5 is deleted and downloaded again.
+        """
+        if os.path.exists(path):
+            if md5 is None or file_md5(path) == md5:
+                return True
+            print(f"Error: md5 mismatch for the existing {path}, downloading it again")
+            os.remove(path)
+        size = size or self.handler.filesize(url)
+        if not size:
+            print(f"Error: could not get the size of {url}")
+            return False
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        part_path, state_path = path + ".part", path + ".part.json"
+        state = self._load_state(state_path, url, size)
+        if not os.path.exists(part_path) or os.path.getsize(part_path) != size:
+            state["done"] = []
+            with open(part_path, 'wb') as f:
+                f.truncate(size)
+        done = set(state["done"])
+        chunks = [index for index in range((size + self.chunk_size - 1) // self.chunk_size) if index not in done]
+        lock = threading.Lock()
+        failed = False
+        with open(part_path, 'r+b') as f:
+            def fetch(index):
+                start = index * self.chunk_size
+                end = min(start + self.chunk_size, size) - 1
+                data = self._fetch_range(url, start, end)
+                if data is None:
+                    return False
+                with lock:
+                    f.seek(start)
+                    f.write(data)
+                    f.flush()
+                    state["done"].append(index)
+                    self._save_state(state_path, state)
+                return True
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = [executor.submit(fetch, index) for index in chunks]
+                for future in as_completed(futures):
+                    if not future.result():
+                        failed = True
+        if failed:
+            print(f"Error: some ranges of {url} failed, rerun to resume")
+            return False
+        if md5 is not None and file_md5(part_path) != md5:
+            print(f"Error: md5 mismatch for {url}, discarding the download")
+            os.remove(part_path)
+            os.remove(state_path)
+            return False
+        os.replace(part_path, path)
+        os.remove(state_path)
+        return True
+    def download_post(self, post, LocalPost, folder, file_name=None):
+        """
+        Downloads the original file of a post into folder and records it in LocalPost, returns the path or None
+        """
+        url = get_post_url(post)
+        if not url:
+            return None
+        if file_name is None:
+            file_name = f"{post.md5 or post.id}.{post.file_ext or url.rsplit('.', 1)[-1]}"
+        path = os.path.join(folder, file_name)
+        if not self.download(url, path, md5=post.md5, size=post.file_size):
+            return None
+        record_local_post(LocalPost, post.id, path)
+        return path
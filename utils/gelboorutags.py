@@ -1,5 +1,6 @@
 import os
 from .proxyhandler import ProxyHandler
+from .tagstore import TagStore, normalize_tag_name
 from typing import List
 import json
 import html
@@ -7,10 +8,13 @@ import logging
 import datetime
 from urllib.parse import quote
 from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 class GelbooruTag:
     """
     Tag dictionary
+    file_name ending with .db keeps the tags in a TagStore instead of loading a jsonl file into memory
+    self.tags and self.type_by_name are keyed by normalize_tag_name(name), so every lookup is a single probe
     """
     TAG_TYPE = {
         0: "general",
@@ -25,16 +29,21 @@ class GelbooruTag:
         exception_handle -> tag type that will be used if tag is not found
         """
         self.file_name = file_name
+        self.use_store = file_name.endswith(".db")
         self.tags = {}
         self.type_by_name = {}
         self.handler = handler
         self.exception_handle = exception_handle # if tag not found, what to do
         self.load()
         self.filewrite_lock = Lock()
+        self.tags_lock = Lock() # guards self.tags and self.type_by_name updates from resolver threads
     def load(self):
         """
         Loads the tags
         """
+        if self.use_store:
+            self.tags = TagStore(self.file_name)
+            return
         if not os.path.exists(self.file_name):
             return
         with open(self.file_name, 'r', encoding='utf-8') as f:
@@ -45,16 +54,15 @@ class GelbooruTag:
                     if isinstance(exce, KeyboardInterrupt):
                         raise exce
                     continue
-                self.tags[tag['name']] = tag
-                self.type_by_name[tag['name']] = tag['type']
-                # add html escaped version
-                escaped_tag_name = html.escape(tag['name']).replace("&#039;", "'")
-                self.tags[escaped_tag_name] = tag
-                self.type_by_name[escaped_tag_name] = tag['type']
+                key = normalize_tag_name(tag['name'])
+                self.tags[key] = tag
+                self.type_by_name[key] = tag['type']
     def save(self):
         """
         Saves the tags
         """
+        if self.use_store:
+            return # the store commits on every add
         with open(self.file_name, 'w', encoding='utf-8') as f:
             for tag in self.tags.values():
                 f.write(json.dumps(tag) + "\n")
@@ -62,6 +70,9 @@ class GelbooruTag:
         """
         Saves the tag
         """
+        if self.use_store:
+            self.tags.add_tags([tag])
+            return
         with self.filewrite_lock:
             with open(self.file_name, 'a', encoding='utf-8') as f:
                 f.write(json.dumps(tag) + "\n")
@@ -77,14 +88,13 @@ class GelbooruTag:
             tags.append(tag)
         return tags
     def reorganize(self, write_to_new_file=True):
-        # writes down the tags into a new file
-        if not write_to_new_file:
-            with open(self.file_name, 'w', encoding='utf-8') as f:
-                for tag_values in self.tags.values():
-                    f.write(json.dumps(tag_values) + "\n")
+        # writes down the tags into a new file, once per tag id
+        if self.use_store:
+            self.tags.compact()
             return
-        with open(self.file_name + "_new", 'w', encoding='utf-8') as f:
-            for tag_values in self.tags.values():
+        unique_tags = {tag_values['id']: tag_values for tag_values in self.tags.values()}
+        with open(self.file_name if not write_to_new_file else self.file_name + "_new", 'w', encoding='utf-8') as f:
+            for tag_values in unique_tags.values():
                 f.write(json.dumps(tag_values) + "\n")
     def reorganize_and_reload(self):
         """
@@ -97,24 +107,8 @@ class GelbooruTag:
         """
         Returns the tag
         """
-        # if startswith backslash, remove it
-        if tag_name.startswith("\\"):
-            tag_name = tag_name[1:]
-        #print(tag_name) #ninomae_ina'nis  -> ninomae_ina&#039;nis
-        basic_escape = tag_name.replace("'", "&#039;")
-        tag_name_urlsafe = html.unescape(tag_name).replace("'", "&#039;")
-        lower_tag_name = tag_name.lower()
-        upper_tag_name = tag_name.upper()
-        #print(tag_name_urlsafe)
-        if tag_name not in self.tags and tag_name_urlsafe not in self.tags and basic_escape not in self.tags and lower_tag_name not in self.tags and upper_tag_name not in self.tags:
-            return None
-        if basic_escape in self.tags:
-            return self.tags[basic_escape]
-        if lower_tag_name in self.tags:
-            return self.tags[lower_tag_name]
-        if upper_tag_name in self.tags:
-            return self.tags[upper_tag_name]
-        return self.tags[tag_name] if tag_name in self.tags else self.tags[tag_name_urlsafe]
+        #ninomae_ina'nis, ninomae_ina&#039;nis -> ninomae_ina'nis
+        return self.tags.get(normalize_tag_name(tag_name))
     def _check_handler(self, handler:ProxyHandler):
         """
         Checks the handler
@@ -135,28 +129,46 @@ class GelbooruTag:
         if tags_string.isspace():
             return []
         self.parse_tags(tags_string, handler, max_retry=max_retry)
-        types = []
-        for tag in tags_string.split(" "):
-            # search self.type_by_name first
-            if tag in self.type_by_name:
-                types.append(self.type_by_name[tag])
-                continue
-            else:
-                # first, search dictionary
-                if (tag_result:=self.get_tag(tag)) is not None:
-                    types.append(tag_result['type'])
-                    # add to self.type_by_name
-                    self.type_by_name[tag] = tag_result['type']
-                    continue
-                logging.error(f"Error: {tag} not found from dictionary")
-                if self.exception_handle is not None:
-                    self.type_by_name[tag] = self.exception_handle
-                    types.append(self.exception_handle)
-                else:
-                    raise Exception(f"Error: {tag} not found from type_by_name")
+        types = [self._get_type(tag) for tag in tags_string.split(" ")]
         if not verbose:
             return types
         return [GelbooruTag.TAG_TYPE[t] for t in types]
+    def get_types_many(self, tags_strings:List[str], handler:ProxyHandler=None, max_workers=8, max_retry=10, verbose=False):
+        """
+        Returns the types of many tag strings (e.g. one per post), as one list per string.
+        Missing tags of all strings are resolved once with resolve_tags_concurrent,
+        then each distinct tag is normalized and looked up only once.
+        """
+        self.resolve_tags_concurrent(tags_strings, handler, max_workers=max_workers, max_retry=max_retry)
+        type_of = {}
+        results = []
+        for tags_string in tags_strings:
+            if tags_string.isspace():
+                results.append([])
+                continue
+            types = []
+            for tag in tags_string.split(" "):
+                if (tag_type:=type_of.get(tag)) is None:
+                    tag_type = type_of[tag] = self._get_type(tag)
+                types.append(tag_type)
+            results.append(types if not verbose else [GelbooruTag.TAG_TYPE[t] for t in types])
+        return results
+    def _get_type(self, tag):
+        """
+        Returns the type id of a tag, exception_handle if it is not in the dictionary
+        """
+        key = normalize_tag_name(tag)
+        # search self.type_by_name first
+        if (tag_type:=self.type_by_name.get(key)) is not None:
+            return tag_type
+        if (tag_result:=self.tags.get(key)) is not None:
+            self.type_by_name[key] = tag_result['type']
+            return tag_result['type']
+        logging.error(f"Error: {tag} not found from dictionary")
+        if self.exception_handle is not None:
+            self.type_by_name[key] = self.exception_handle
+            return self.exception_handle
+        raise Exception(f"Error: {tag} not found from type_by_name")
     def structured_tags(self, tags_string, handler:ProxyHandler=None, max_retry=10):
         """
         Returns the tags and classes as a dictionary
@@ -203,25 +215,29 @@ class GelbooruTag:
         """
         if not tag_names:
             return
-        missing_tags = []
-        for tag_name in tag_names:
-            if self.get_tag(tag_name):
-                continue
-            missing_tags.append(tag_name)
+        missing_tags = [tag_name for tag_name in tag_names if not self.get_tag(tag_name)]
         if not missing_tags:
             return
-        tag_name = " ".join(missing_tags)
-        # unescape html
-        tag_name = html.unescape(tag_name).replace("&#039;", "'")
-        # url encode
-        tag_name = quote(tag_name, safe='')
         try:
-            self._check_handler(handler)
+            handler = self._check_handler(handler)
         except RuntimeError as e:
             if self.exception_handle is not None:
                 for tag in missing_tags:
-                    self.type_by_name[tag] = self.exception_handle
+                    self.type_by_name[normalize_tag_name(tag)] = self.exception_handle
                 return
+        tags = self._fetch_tags(missing_tags, handler, max_retry=max_retry)
+        if tags is not None:
+            self._add_tags(tags)
+    def _fetch_tags(self, missing_tags:List[str], handler:ProxyHandler, max_retry=10):
+        """
+        Requests up to 100 tags from gelbooru, returns the list of tag dictionaries or None after max_retry failures.
+        This does not modify the dictionary, so it can run in resolver threads.
+        """
+        tag_name = " ".join(missing_tags)
+        # unescape html
+        tag_name = html.unescape(tag_name).replace("&#039;", "'")
+        # url encode
+        tag_name = quote(tag_name, safe='')
         for i in range(max_retry):
             try:
                 response = handler.get_response(f"https://gelbooru.com/index.php?page=dapi&s=tag&q=index&json=1&names={tag_name}")
@@ -236,29 +252,71 @@ class GelbooruTag:
                     print(f"Error: {tag_name} not found from response {response}")
                     continue
                 # {"@attributes":{"limit":100,"offset":0,"count":4},"tag":[{"id":152532,"name":"1girl","count":6177827,"type":0,"ambiguous":0},{"id":138893,"name":"1boy","count":1481404,"type":0,"ambiguous":0},{"id":444,"name":"apron","count":174832,"type":0,"ambiguous":0},{"id":135309,"name":"blunt_bangs","count":233912,"type":0,"ambiguous":0}]}
-                for tag in tag['tag']:
-                    self.tags[tag['name']] = tag
-                    self.type_by_name[tag['name']] = tag['type']
-                    # add html escaped version
-                    escaped_tag_name = html.escape(tag['name']).replace("&#039;", "'")
-                    self.tags[escaped_tag_name] = tag
-                    self.type_by_name[escaped_tag_name] = tag['type']
-                    # lower case
-                    lower_tag_name = tag['name'].lower()
-                    self.tags[lower_tag_name] = tag
-                    self.type_by_name[lower_tag_name] = tag['type']
-                    self.save_tag(tag)
-                return
+                return tag['tag']
             except Exception as e:
                 logging.exception(f"Exception: {e} when getting tag {tag_name}, retrying {i}/{max_retry}")
                 print(f"Exception: {e} when getting tag {tag_name}, retrying {i}/{max_retry}")
                 pass
         print(f"Error: {tag_name} not found after {max_retry} retries")
+        return None
+    def _add_tags(self, tags):
+        """
+        Adds fetched tag dictionaries to the dictionary and appends them to the file
+        """
+        with self.tags_lock:
+            if self.use_store:
+                self.tags.add_tags(tags) # one transaction for the whole batch
+                for tag in tags:
+                    self.type_by_name[normalize_tag_name(tag['name'])] = tag['type']
+                return
+            for tag in tags:
+                key = normalize_tag_name(tag['name'])
+                self.tags[key] = tag
+                self.type_by_name[key] = tag['type']
+            with self.filewrite_lock:
+                with open(self.file_name, 'a', encoding='utf-8') as f:
+                    f.write("".join(json.dumps(tag) + "\n" for tag in tags))
+    def resolve_tags_concurrent(self, tags_strings:List[str], handler:ProxyHandler=None, max_workers=8, max_retry=10):
+        """
+        Resolves the missing tags of many tag strings (e.g. many posts) at once.
+        Missing names are deduplicated, packed into 100-name requests and fetched with max_workers requests in flight,
+        which the handler spreads over its proxies. Returns the number of tags added.
+        """
+        missing_tags = {}
+        seen = set()
+        for tags_string in tags_strings:
+            for tag in tags_string.split(" "):
+                if tag in seen or not tag.strip():
+                    continue
+                seen.add(tag)
+                key = normalize_tag_name(tag)
+                if key not in missing_tags and key not in self.tags:
+                    missing_tags[key] = tag
+        missing_tags = list(missing_tags.values())
+        if not missing_tags:
+            return 0
+        try:
+            handler = self._check_handler(handler)
+        except RuntimeError as e:
+            if self.exception_handle is None:
+                raise
+            for tag in missing_tags:
+                self.type_by_name[normalize_tag_name(tag)] = self.exception_handle
+            return 0
+        added = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self._fetch_tags, missing_tags[i:i+100], handler, max_retry) for i in range(0, len(missing_tags), 100)]
+            for future in as_completed(futures):
+                tags = future.result()
+                if tags:
+                    self._add_tags(tags)
+                    added += len(tags)
+        return added
     def tag_exists(self, tag_name):
         """
         Returns if the tag exists
         """
-        return tag_name in self.tags
+        return normalize_tag_name(tag_name) in self.tags
 
 
 class GelbooruMetadata:
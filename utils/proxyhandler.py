@@ -2,11 +2,16 @@
 Proxy Handler Class
 """
 import json
+import heapq
 from queue import Queue
 import time
 import urllib.parse
 import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 
 class ThreadSafeDict(dict):
     """
@@ -40,15 +45,187 @@ class ThreadSafeDict(dict):
         with self.lock:
             return super().__str__()
 
+class ConnectionCounter:
+    """
+    Counts the requests and TCP connects of one proxy session
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connects = 0
+        self.failed_connects = 0
+    def add(self, requests=0, connects=0, failed_connects=0):
+        with self.lock:
+            self.requests += requests
+            self.connects += connects
+            self.failed_connects += failed_connects
+
+class CountingConnectionMixin:
+    """
+    Reports every connect() of an urllib3 connection to counter, urllib3 reconnects dropped connections on the same object
+    """
+    counter = None
+    def connect(self):
+        try:
+            super().connect()
+        except Exception:
+            self.counter.add(failed_connects=1)
+            raise
+        self.counter.add(connects=1)
+
+def counting_pool_classes(counter:ConnectionCounter):
+    """
+    Returns urllib3 pool classes by scheme whose connections report to counter
+    """
+    pool_classes = {}
+    for scheme, pool_class, connection_class in (("http", HTTPConnectionPool, HTTPConnection), ("https", HTTPSConnectionPool, HTTPSConnection)):
+        counting_connection = type(f"Counting{connection_class.__name__}", (CountingConnectionMixin, connection_class), {"counter": counter})
+        pool_classes[scheme] = type(f"Counting{pool_class.__name__}", (pool_class,), {"ConnectionCls": counting_connection})
+    return pool_classes
+
+class ProxyScheduler:
+    """
+    Hands out the proxy that becomes available first, each proxy is used at most once per wait_time.
+    Tracks latency and error rate (exponential moving averages) per proxy, proxies can be put on cooldown (429).
+    A proxy whose error rate reaches eject_error_rate after min_samples requests is ejected unless it is the last one,
+    a background thread re-probes ejected proxies every probe_interval seconds with probe(index) -> bool.
+    Without a probe function ejected proxies come back after probe_interval.
+    """
+    def __init__(self, count, wait_time=0.1, probe=None, alpha=0.2, eject_error_rate=0.5, min_samples=5, probe_interval=30):
+        self.count = count
+        self.wait_time = wait_time
+        self.probe = probe
+        self.alpha = alpha
+        self.eject_error_rate = eject_error_rate
+        self.min_samples = min_samples
+        self.probe_interval = probe_interval
+        self.condition = threading.Condition()
+        self.available_at = [0.0] * count
+        self.latency = [0.0] * count
+        self.error_rate = [0.0] * count
+        self.samples = [0] * count
+        self.ejected = set()
+        self.probe_thread = None
+        self.closed = False
+        # (available at, latency, index), entries are stale if available_at changed since
+        self.heap = [(0.0, 0.0, i) for i in range(count)]
+    def _push(self, index):
+        heapq.heappush(self.heap, (self.available_at[index], self.latency[index], index))
+    def acquire(self, timeout=None):
+        """
+        Blocks until a healthy proxy is available and reserves it, returns its index or None on timeout
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                while self.heap and (self.heap[0][2] in self.ejected or self.heap[0][0] != self.available_at[self.heap[0][2]]):
+                    heapq.heappop(self.heap)
+                now = time.time()
+                if self.heap and self.heap[0][0] <= now:
+                    index = heapq.heappop(self.heap)[2]
+                    self.available_at[index] = now + self.wait_time
+                    self._push(index)
+                    return index
+                wait = self.heap[0][0] - now if self.heap else self.probe_interval
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    wait = min(wait, deadline - now)
+                self.condition.wait(wait)
+    def release(self, index, latency=None, success=True, cooldown=None):
+        """
+        Records the result of a request sent through the proxy at index
+        """
+        with self.condition:
+            if index >= self.count:
+                return
+            if success and latency is not None:
+                self.latency[index] = latency if self.samples[index] == 0 else (1 - self.alpha) * self.latency[index] + self.alpha * latency
+            self.error_rate[index] = (1 - self.alpha) * self.error_rate[index] + self.alpha * (0.0 if success else 1.0)
+            self.samples[index] += 1
+            if cooldown:
+                self.available_at[index] = max(self.available_at[index], time.time() + cooldown)
+                self._push(index)
+            if self.samples[index] >= self.min_samples and self.error_rate[index] >= self.eject_error_rate:
+                self._eject(index)
+            self.condition.notify_all()
+    def cooldown(self, index, seconds):
+        """
+        Keeps the proxy at index unused for seconds, counted as a failed request
+        """
+        self.release(index, success=False, cooldown=seconds)
+    def _eject(self, index):
+        if index in self.ejected or len(self.ejected) + 1 >= self.count:
+            return # the last proxy in rotation is kept
+        self.ejected.add(index)
+        print(f"Proxy {index} ejected, error rate {self.error_rate[index]:.2f}")
+        if self.probe_thread is None or not self.probe_thread.is_alive():
+            self.probe_thread = threading.Thread(target=self._probe_loop, daemon=True)
+            self.probe_thread.start()
+    def _probe_loop(self):
+        """
+        Re-probes ejected proxies until none are left
+        """
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed, timeout=self.probe_interval)
+                if self.closed or not self.ejected:
+                    self.probe_thread = None
+                    return
+                ejected = list(self.ejected)
+            for index in ejected:
+                try:
+                    healthy = self.probe(index) if self.probe is not None else True
+                except Exception:
+                    healthy = False
+                if healthy:
+                    self.readmit(index)
+    def readmit(self, index):
+        """
+        Puts an ejected proxy back into rotation with a clean error rate
+        """
+        with self.condition:
+            if index not in self.ejected:
+                return
+            self.ejected.discard(index)
+            self.error_rate[index] = 0.0
+            self.samples[index] = 0
+            self.available_at[index] = time.time()
+            self._push(index)
+            print(f"Proxy {index} readmitted")
+            self.condition.notify_all()
+    def get_stats(self):
+        """
+        Returns per proxy latency, error rate, samples, seconds until available and whether it is ejected
+        """
+        now = time.time()
+        with self.condition:
+            return [{
+                "latency": self.latency[i],
+                "error_rate": self.error_rate[i],
+                "samples": self.samples[i],
+                "available_in": max(self.available_at[i] - now, 0.0),
+                "ejected": i in self.ejected,
+            } for i in range(self.count)]
+    def close(self):
+        """
+        Stops the probe thread
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
 class ProxyHandler:
     """
     Sends request to http://{ip}:{port}/get_response_raw?url={url} with auth 
+    Each proxy gets a persistent keep-alive session with up to pool_size connections,
+    connection errors and 502/503/504 are retried max_retries times by the adapter.
+    Requests are scheduled by a ProxyScheduler, failing proxies are ejected and re-probed in the background.
     """
-    def __init__(self, proxy_list_file,proxy_auth="user:pass",port=80, wait_time=0.1,timeouts=10):
+    def __init__(self, proxy_list_file,proxy_auth="user:pass",port=80, wait_time=0.1,timeouts=10, pool_size=10, max_retries=3):
         self.proxy_auth = proxy_auth
         self.port = port
         self.proxy_list = []
-        self.commit_time = ThreadSafeDict()
         self.timeouts = timeouts
         self.wait_time = wait_time
         self.lock = threading.Lock()
@@ -65,6 +242,77 @@ class ProxyHandler:
                 proxy += "/"
             self.proxy_list[i] = proxy
         self.proxy_index = -1
+        self._init_sessions(pool_size, max_retries)
+        self._init_scheduler()
+    def _init_sessions(self, pool_size, max_retries):
+        """
+        Creates one session per proxy
+        """
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.auth = tuple(self.proxy_auth.split(":", 1))
+        self.request_count = 0
+        self.sessions = [self._create_session() for _ in self.proxy_list]
+    def _init_scheduler(self):
+        """
+        Creates the scheduler over the current proxy list
+        """
+        if getattr(self, "scheduler", None) is not None:
+            self.scheduler.close()
+        self.scheduler = ProxyScheduler(len(self.proxy_list), self.wait_time, probe=self._probe)
+    def _probe(self, index):
+        """
+        Returns True if the proxy at index answers
+        """
+        return self._request(index, "", timeout=2).status_code == 200
+    def _create_session(self):
+        """
+        Returns a keep-alive session with a connection pool and retry adapter
+        """
+        session = requests.Session()
+        session.auth = self.auth
+        retry = Retry(total=self.max_retries, connect=self.max_retries, read=0, status=self.max_retries,
+                      backoff_factor=0.1, status_forcelist=(502, 503, 504), allowed_methods=["GET"], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session.connection_counter = ConnectionCounter()
+        adapter.poolmanager.pool_classes_by_scheme = counting_pool_classes(session.connection_counter)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+    def _request(self, index, path, timeout=None):
+        """
+        Sends a GET to the proxy at index through its session
+        """
+        with self.lock:
+            self.request_count += 1
+        self.sessions[index].connection_counter.add(requests=1)
+        return self.sessions[index].get(self.proxy_list[index] + path, timeout=timeout or self.timeouts)
+    def get_connection_stats(self):
+        """
+        Returns the requests, TCP connects, failed connects and requests sent on a reused connection,
+        in total and per proxy under "proxies". Adapter retries are not counted as requests.
+        """
+        proxies = []
+        for proxy, session in zip(self.proxy_list, self.sessions):
+            counter = session.connection_counter
+            with counter.lock:
+                proxies.append({
+                    "proxy": proxy,
+                    "requests": counter.requests,
+                    "connections": counter.connects,
+                    "failed_connections": counter.failed_connects,
+                    "reused": max(counter.requests - counter.connects - counter.failed_connects, 0),
+                })
+        stats = {key: sum(proxy[key] for proxy in proxies) for key in ("requests", "connections", "failed_connections", "reused")}
+        stats["proxies"] = proxies
+        return stats
+    def close(self):
+        """
+        Closes the proxy sessions
+        """
+        self.scheduler.close()
+        for session in self.sessions:
+            session.close()
     def log_time(self):
         """
         Logs the time
@@ -81,46 +329,58 @@ class ProxyHandler:
         if len(self.last_logged_activities.queue) > 1:
             return (self.last_logged_activities.queue[-1] - self.last_logged_activities.queue[0]) / self.last_logged_activities.qsize()
         return 0
-    def wait_until_commit(self, proxy_index=None):
+    def _update_proxy_index(self):
         """
-        Waits until the commit time
+        Returns the index of the next proxy from the scheduler
         """
-        if proxy_index is None:
-            proxy_index = self.proxy_index
-        if proxy_index not in self.commit_time:
-            self.commit_time[proxy_index] = 0
-        while time.time() < self.commit_time[proxy_index] + self.wait_time:
-            time.sleep(0.01)
-        self.commit_time[proxy_index] = time.time()
-    def _update_proxy_index(self):
+        self.proxy_index = self.scheduler.acquire()
+        return self.proxy_index
+    def _scheduled_request(self, path, is_throttled=None):
         """
-        Updates the proxy index
+        Sends a GET through the next scheduled proxy and reports the outcome to the scheduler once.
+        Returns (index, response), 429 puts the proxy on cooldown for timeouts seconds.
+        is_throttled(response) flags a 200 response as rate limited too (e.g. a 429 in its body).
         """
-        with self.lock:
-            self.proxy_index = (self.proxy_index + 1) % len(self.proxy_list)
-            return self.proxy_index
+        index = self._update_proxy_index()
+        start_time = time.time()
+        try:
+            response = self._request(index, path)
+        except Exception:
+            self.scheduler.release(index, success=False)
+            raise
+        throttled = response.status_code == 429 or (response.status_code == 200 and is_throttled is not None and is_throttled(response))
+        self.scheduler.release(index, time.time() - start_time, success=response.status_code < 500 and not throttled,
+                               cooldown=self.timeouts if throttled else None)
+        return index, response
+    @staticmethod
+    def _is_throttled_response(response):
+        """
+        Returns True if a get_response payload reports a 429 from the proxied site
+        """
+        try:
+            json_response = response.json()
+        except ValueError:
+            return False
+        return not json_response.get("success") and "429" in str(json_response.get("response"))
     def get_response(self, url):
         """
         Returns the response of the url
         """
         url = urllib.parse.quote(url, safe='')
         try:
-            index = self._update_proxy_index()
-            self.wait_until_commit(index)
             self.log_time()
-            response = requests.get(self.proxy_list[index] + f"get_response?url={url}", timeout=self.timeouts, auth=tuple(self.proxy_auth.split(":")))
+            _, response = self._scheduled_request(f"get_response?url={url}", self._is_throttled_response)
             if response.status_code == 200:
                 json_response = response.json()
                 if json_response["success"]:
                     return json.loads(json_response["response"])
                 else:
                     if "429" in json_response["response"]:
-                        self.commit_time[index] = time.time() + self.timeouts
+                        # the proxy was put on cooldown by _scheduled_request
                         print(f"Error: {json_response['response']}, waiting {self.timeouts} seconds")
                     print(f"Failed in proxy side: {json_response['response']}")
                     return None
             elif response.status_code == 429:
-                self.commit_time[index] = time.time() + self.timeouts
                 print(f"Error: {response.status_code}, waiting {self.timeouts} seconds")
             else:
                 print(f"Failed in proxy side: {response.status_code}")
@@ -134,9 +394,7 @@ class ProxyHandler:
         """
         url = urllib.parse.quote(url, safe='')
         try:
-            index = self._update_proxy_index()
-            self.wait_until_commit(index)
-            response = requests.get(self.proxy_list[index] + f"get_response_raw?url={url}", timeout=self.timeouts, auth=tuple(self.proxy_auth.split(":")))
+            _, response = self._scheduled_request(f"get_response_raw?url={url}")
             if response.status_code == 200:
                 return response
             else:
@@ -151,9 +409,7 @@ class ProxyHandler:
         """
         url = urllib.parse.quote(url, safe='')
         try:
-            index = self._update_proxy_index()
-            self.wait_until_commit(index)
-            response = requests.get(self.proxy_list[index] + f"file_size?url={url}", timeout=self.timeouts, auth=tuple(self.proxy_auth.split(":")))
+            _, response = self._scheduled_request(f"file_size?url={url}")
             if response.status_code == 200:
                 return int(response.text)
             else:
@@ -168,9 +424,7 @@ class ProxyHandler:
         """
         url = urllib.parse.quote(url, safe='')
         try:
-            index = self._update_proxy_index()
-            self.wait_until_commit(index)
-            response = requests.get(self.proxy_list[index] + f"filepart?url={url}&start={start}&end={end}", timeout=self.timeouts, auth=tuple(self.proxy_auth.split(":")))
+            _, response = self._scheduled_request(f"filepart?url={url}&start={start}&end={end}")
             if response.status_code == 200:
                 return response
             else:
@@ -186,7 +440,7 @@ class ProxyHandler:
         failed_proxies = []
         for i, proxy in enumerate(self.proxy_list):
             try:
-                response = requests.get(proxy, auth=tuple(self.proxy_auth.split(":")), timeout=2)
+                response = self._request(i, "", timeout=2)
                 if response.status_code == 200:
                     continue
                 else:
@@ -203,8 +457,10 @@ class ProxyHandler:
                 # remove failed proxies
                 for i in failed_proxies[::-1]:
                     del self.proxy_list[i]
+                    self.sessions.pop(i).close()
                 if len(self.proxy_list) == 0:
                     raise Exception("No proxies available")
+                self._init_scheduler()
         else:
             print(f"All {len(self.proxy_list)} proxies are working")
 
@@ -212,12 +468,14 @@ class SingleProxyHandler(ProxyHandler):
     """
     Sends request to http://{ip}:{port}/get_response_raw?url={url} with auth
     """
-    def __init__(self, proxy_url, proxy_auth="user:pass",port=80, wait_time=0.1,timeouts=10):
+    def __init__(self, proxy_url, proxy_auth="user:pass",port=80, wait_time=0.1,timeouts=10, pool_size=10, max_retries=3):
         self.proxy_auth = proxy_auth
         self.port = port
         self.proxy_list = [proxy_url]
         self.proxy_index = -1
-        self.commit_time = ThreadSafeDict()
         self.timeouts = timeouts
         self.wait_time = wait_time
         self.lock = threading.Lock()
+        self.last_logged_activities = Queue(maxsize=100)
+        self._init_sessions(pool_size, max_retries)
+        self._init_scheduler()
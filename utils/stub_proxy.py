@@ -0,0 +1,120 @@
+"""
+Local stub of the proxy server API, to check ProxyHandler users without network access.
+/get_response answers the gelbooru tag API, every requested name exists as a general tag.
+Usage:
+    python -m utils.stub_proxy # checks GelbooruTag.resolve_tags_concurrent against two stub proxies
+    server = StubProxyServer(latency=0.05)
+    ProxyHandler(proxy_file) # with a line 127.0.0.1:{server.port}
+    server.close()
+"""
+import os
+import json
+import time
+import zlib
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from .proxyhandler import ProxyHandler
+from .gelboorutags import GelbooruTag
+
+class StubProxyRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves / (health probe) and /get_response?url={gelbooru tag api url}
+    """
+    def log_message(self, format, *args):
+        pass
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path == "/":
+            self._send("ok")
+            return
+        if parsed.path != "/get_response":
+            self.send_error(404)
+            return
+        url = parse_qs(parsed.query)["url"][0]
+        names = parse_qs(urlparse(url).query)["names"][0].split(" ")
+        self.server.begin_request(names)
+        try:
+            time.sleep(self.server.latency)
+            tags = [{"id": zlib.crc32(name.encode("utf-8")), "name": name, "count": 1, "type": 0, "ambiguous": 0} for name in names]
+            self._send(json.dumps({"success": True, "response": json.dumps({"tag": tags})}))
+        finally:
+            self.server.end_request()
+    def _send(self, body):
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class StubProxyServer(ThreadingHTTPServer):
+    """
+    Stub proxy on 127.0.0.1 (port 0 picks a free port), served from a daemon thread.
+    Records the requested tag names and the highest number of requests in flight.
+    """
+    daemon_threads = True
+    def __init__(self, port=0, latency=0.05):
+        super().__init__(("127.0.0.1", port), StubProxyRequestHandler)
+        self.port = self.server_address[1]
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.requested_names = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+    def begin_request(self, names):
+        with self.lock:
+            self.requests += 1
+            self.requested_names.extend(names)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+    def end_request(self):
+        with self.lock:
+            self.in_flight -= 1
+    def close(self):
+        """
+        Stops serving and closes the socket
+        """
+        self.shutdown()
+        self.server_close()
+
+def check_resolve_tags_concurrent(posts=500, tags_per_post=30, vocabulary=2000, max_workers=8):
+    """
+    Resolves the tags of many posts through two stub proxies and checks that every missing name is requested once,
+    requests overlap, the tags reach the jsonl file and resolved posts need no further requests.
+    """
+    servers = [StubProxyServer(), StubProxyServer()]
+    with tempfile.TemporaryDirectory() as folder:
+        proxy_file = os.path.join(folder, "proxies.txt")
+        with open(proxy_file, "w", encoding="utf-8") as f:
+            f.write("".join(f"127.0.0.1:{server.port}\n" for server in servers))
+        handler = ProxyHandler(proxy_file, wait_time=0)
+        tag_file = os.path.join(folder, "gelbooru_tags.jsonl")
+        tag_handler = GelbooruTag(file_name=tag_file, handler=handler)
+        tags_strings = [" ".join(f"tag_{(i * 7 + j) % vocabulary}" for j in range(tags_per_post)) for i in range(posts)]
+        expected = {tag for tags_string in tags_strings for tag in tags_string.split(" ")}
+        start_time = time.time()
+        added = tag_handler.resolve_tags_concurrent(tags_strings, max_workers=max_workers)
+        elapsed = time.time() - start_time
+        requested = [name for server in servers for name in server.requested_names]
+        requests = sum(server.requests for server in servers)
+        assert added == len(expected), f"added {added} tags, expected {len(expected)}"
+        assert sorted(requested) == sorted(expected), "a tag was requested twice or not at all"
+        assert requests == -(-len(expected) // 100), f"{requests} requests for {len(expected)} tags"
+        assert all(server.requests > 0 for server in servers), "a proxy was never used"
+        assert max(server.max_in_flight for server in servers) > 1, "requests did not overlap"
+        types = tag_handler.get_types_many(tags_strings[:10], verbose=True)
+        assert all(tag_type == "general" for post_types in types for tag_type in post_types)
+        assert sum(server.requests for server in servers) == requests, "resolved tags were requested again"
+        assert len(GelbooruTag(file_name=tag_file).tags) == len(expected), "tags were not written to the jsonl file"
+        handler.close()
+    for server in servers:
+        server.close()
+    print(f"Resolved {added} tags of {posts} posts with {requests} requests in {elapsed:.2f}s, "
+          f"max in flight per proxy {[server.max_in_flight for server in servers]}")
+
+if __name__ == "__main__":
+    check_resolve_tags_concurrent()
@@ -0,0 +1,155 @@
+"""
+SQLite Tag Store Class
+"""
+import os
+import json
+import html
+import sqlite3
+from threading import Lock
+from typing import List
+
+KEY_VERSION = 1 # PRAGMA user_version of stores whose keys are normalize_tag_name keys
+
+def normalize_tag_name(tag_name):
+    """
+    Returns the canonical lookup key of a tag name: without a leading backslash, html unescaped and lower case.
+    ninomae_ina&#039;nis, ninomae_ina'nis and NINOMAE_INA'NIS share the key ninomae_ina'nis
+    """
+    if tag_name.startswith("\\"):
+        tag_name = tag_name[1:]
+    return html.unescape(tag_name).lower()
+
+class TagStore:
+    """
+    On-disk tag dictionary, drop-in for the GelbooruTag.tags dict without loading every tag.
+    Each tag is stored once by id, its normalize_tag_name key points to the id through the primary key index.
+    Usage:
+        store = TagStore("gelbooru_tags.db")
+        store.import_jsonl("gelbooru_tags.jsonl") # once
+        store.get(normalize_tag_name("1girl")) # {"id": 152532, "name": "1girl", "count": 6177827, "type": 0, "ambiguous": 0}
+    """
+    def __init__(self, file_name="gelbooru_tags.db"):
+        self.file_name = file_name
+        self.lock = Lock()
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS tag (id INTEGER PRIMARY KEY, name TEXT NOT NULL, type INTEGER, data TEXT NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS tagkey (key TEXT PRIMARY KEY, id INTEGER NOT NULL) WITHOUT ROWID")
+        self.connection.commit()
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] < KEY_VERSION:
+            self._rebuild_keys()
+    def _rebuild_keys(self):
+        """
+        Recreates the lookup keys from the tag names, used when the key normalization changed
+        """
+        with self.lock:
+            with self.connection:
+                names = self.connection.execute("SELECT id, name FROM tag ORDER BY id").fetchall()
+                self.connection.execute("DELETE FROM tagkey")
+                self.connection.executemany("INSERT OR REPLACE INTO tagkey (key, id) VALUES (?, ?)", [(normalize_tag_name(name), tag_id) for tag_id, name in names])
+                self.connection.execute(f"PRAGMA user_version = {KEY_VERSION}")
+    def get(self, key, default=None):
+        """
+        Returns the tag dictionary of a normalize_tag_name key
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT tag.data FROM tagkey JOIN tag ON tag.id = tagkey.id WHERE tagkey.key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+    def get_many(self, keys:List[str]):
+        """
+        Returns key -> tag dictionary for the keys that exist
+        """
+        result = {}
+        keys = list(dict.fromkeys(keys))
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                placeholders = ", ".join("?" * len(chunk))
+                for key, data in self.connection.execute(f"SELECT tagkey.key, tag.data FROM tagkey JOIN tag ON tag.id = tagkey.id WHERE tagkey.key IN ({placeholders})", chunk):
+                    result[key] = json.loads(data)
+        return result
+    def add_tags(self, tags:List[dict]):
+        """
+        Adds or replaces tags in one transaction, a tag with a known id replaces the stored one
+        """
+        tag_rows = [(tag['id'], tag['name'], tag.get('type'), json.dumps(tag)) for tag in tags]
+        key_rows = [(normalize_tag_name(tag['name']), tag['id']) for tag in tags]
+        with self.lock:
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO tag (id, name, type, data) VALUES (?, ?, ?, ?)", tag_rows)
+                self.connection.executemany("INSERT OR REPLACE INTO tagkey (key, id) VALUES (?, ?)", key_rows)
+    def import_jsonl(self, file_name, batch_size=10000):
+        """
+        Imports a gelbooru_tags.jsonl file, duplicated lines collapse into one tag per id. Returns the number of lines imported.
+        """
+        if not os.path.exists(file_name):
+            return 0
+        imported = 0
+        batch = []
+        with open(file_name, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    tag = json.loads(line)
+                except Exception as exce:
+                    if isinstance(exce, KeyboardInterrupt):
+                        raise exce
+                    continue
+                batch.append(tag)
+                if len(batch) >= batch_size:
+                    self.add_tags(batch)
+                    imported += len(batch)
+                    batch = []
+        if batch:
+            self.add_tags(batch)
+            imported += len(batch)
+        return imported
+    def export_jsonl(self, file_name):
+        """
+        Writes every tag once to a jsonl file
+        """
+        with open(file_name, 'w', encoding='utf-8') as f:
+            for tag in self.values():
+                f.write(json.dumps(tag) + "\n")
+    def compact(self):
+        """
+        Drops keys whose tag is gone, keeps only the newest id when tags share a name and vacuums the file.
+        Returns the number of removed tags.
+        """
+        with self.lock:
+            with self.connection:
+                removed = self.connection.execute("DELETE FROM tag WHERE id NOT IN (SELECT MAX(id) FROM tag GROUP BY name)").rowcount
+                self.connection.execute("DELETE FROM tagkey WHERE id NOT IN (SELECT id FROM tag)")
+            self.connection.execute("VACUUM")
+        return removed
+    def values(self):
+        """
+        Yields every tag dictionary once, in id order
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT data FROM tag ORDER BY id").fetchall()
+        for row in rows:
+            yield json.loads(row[0])
+    def close(self):
+        """
+        Closes the connection
+        """
+        with self.lock:
+            self.connection.close()
+    def __getitem__(self, key):
+        tag = self.get(key)
+        if tag is None:
+            raise KeyError(key)
+        return tag
+    def __setitem__(self, key, tag):
+        self.add_tags([tag])
+        if key != normalize_tag_name(tag['name']):
+            with self.lock:
+                with self.connection:
+                    self.connection.execute("INSERT OR REPLACE INTO tagkey (key, id) VALUES (?, ?)", (key, tag['id']))
+    def __contains__(self, key):
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM tagkey WHERE key = ?", (key,)).fetchone() is not None
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM tag").fetchone()[0]